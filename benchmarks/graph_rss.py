@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Peak RSS of fetching and uploading graphs with and without StreamGraphs.
+
+Starts a fake Zabbix frontend (index.php login and chart2.php serving a PNG
+of --graph-size bytes) and fetches --concurrency graphs at the same time
+through zabbix_frontend.get_graph, keeping them all until the last one is in,
+like a dashboard. Peak RSS is sampled after fetching, and again after
+building the multipart body of a Telegram sendPhoto request for every graph,
+the way the bot's requests-based upload does: that reads the whole file into
+memory, streamed or not. Every mode runs in its own process, since peak RSS
+never goes down:
+
+    python benchmarks/graph_rss.py [--graph-size BYTES] [--concurrency N]
+"""
+import argparse
+import concurrent.futures
+import http.server
+import os
+import requests
+import resource
+import subprocess
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import zabbix_frontend
+
+
+class FakeFrontend(http.server.BaseHTTPRequestHandler):
+    graph = b''
+
+    def do_POST(self):
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'zbx_session=benchmark')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(self.graph)))
+        self.end_headers()
+
+        # Send it in pieces, like a frontend rendering a big graph
+        for offset in range(0, len(self.graph), 64 * 1024):
+            self.wfile.write(self.graph[offset:offset + 64 * 1024])
+
+    def log_message(self, *args):
+        pass
+
+
+def max_rss_kib():
+    # Linux reports KiB, macOS bytes
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 if sys.platform == 'darwin' else max_rss
+
+
+def run(stream, graph_size, concurrency):
+    graph = b'\x89PNG' + os.urandom(graph_size - 4)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeFrontend)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # No graph cache, so only fetching is measured
+    zabbix_frontend.init('http://127.0.0.1:%s' % server.server_port, 'benchmark', 'benchmark',
+            graph_cache_entries = 0, graph_fresh_age = 0, max_graph_size = 2 * graph_size)
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    def fetch(graph_id):
+        return zabbix_frontend.get_graph(graph_id, 'now-1h', 'now', 1200, 400, stream=stream)
+
+    # Warm up threads, sockets and login with tiny graphs, which leaves the
+    # peak RSS where it was
+    FakeFrontend.graph = graph[:1024]
+    for warmup_graph in pool.map(fetch, range(concurrency)):
+        if stream: warmup_graph.close()
+
+    FakeFrontend.graph = graph
+    baseline = max_rss_kib()
+
+    graphs = list(pool.map(fetch, range(concurrency)))
+    fetch_peak = max_rss_kib()
+
+    # Prepare all uploads at once, like sending them concurrently
+    uploads = list(pool.map(upload, graphs))
+    upload_peak = max_rss_kib()
+
+    del uploads
+    if stream:
+        for graph in graphs:
+            graph.close()
+
+    server.shutdown()
+
+    return baseline, fetch_peak, upload_peak
+
+
+def upload(graph):
+    return requests.Request('POST', 'https://api.telegram.org/botTOKEN/sendPhoto',
+            data = { 'chat_id': '1' }, files = { 'photo': graph }).prepare()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--graph-size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--mode', choices=[ 'stream', 'memory' ], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        baseline, fetch_peak, upload_peak = run(args.mode == 'stream', args.graph_size, args.concurrency)
+        print('%-7s %8.0f KiB per graph fetched %8.0f KiB per graph fetched and uploaded' % (
+                args.mode, (fetch_peak - baseline) / args.concurrency, (upload_peak - baseline) / args.concurrency))
+        return
+
+    print('%s concurrent graphs of %s bytes, peak RSS growth:' % (args.concurrency, args.graph_size))
+    for mode in [ 'memory', 'stream' ]:
+        subprocess.run([ sys.executable, __file__, '--mode', mode,
+                '--graph-size', str(args.graph_size), '--concurrency', str(args.concurrency) ], check=True)
+
+
+if __name__ == '__main__':
+    main()
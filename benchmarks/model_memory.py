@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Memory use and build time of the hostgroup/host model, compared to the
+per-host and per-hostgroup dicts it replaced. Reports totals, and bytes and
+µs per host entry and per hostgroup.
+
+Runs on synthetic hostgroup.get output, no Zabbix needed:
+
+    python benchmarks/model_memory.py [--hostgroups N] [--hosts-per-group N]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telegram.model import Host, HostGroup
+
+
+def hostgroup_get_reply(hostgroups, hosts_per_group):
+    """
+    JSON text of what hostgroup.get(selectHosts = [ 'hostid', 'name' ])
+    returns for a super admin. Every host is in two groups, like hosts
+    usually are (e.g. a customer group and a "Linux servers" group).
+    """
+    host_count = max(1, hostgroups * hosts_per_group // 2)
+
+    result = []
+    for group in range(hostgroups):
+        first_host = group * hosts_per_group // 2
+        result.append({
+            'groupid': str(1000 + group),
+            'name': 'Customers/Customer %s' % group,
+            'hosts': [ {
+                'hostid': str(10000 + (first_host + i) % host_count),
+                'name': 'host-%s.example.com' % ((first_host + i) % host_count),
+            } for i in range(hosts_per_group) ],
+        })
+
+    return json.dumps(result)
+
+
+def build_dicts(result):
+    """
+    The dicts get_hostgroups_hosts_for_user built before the slotted model.
+    """
+    hosts_for_hostgroup = {}
+    for hostgroup in result:
+        hosts = [ { 'id': host['hostid'], 'name': host['name'] } for host in hostgroup['hosts'] ]
+
+        hosts_for_hostgroup[hostgroup['name']] = {
+                'id': hostgroup['groupid'],
+                'hosts': hosts,
+        }
+
+    return hosts_for_hostgroup
+
+
+def build_model(result):
+    return { hostgroup['name']: HostGroup(hostgroup['groupid'], hostgroup['name'],
+            [ Host(host['hostid'], host['name']) for host in hostgroup['hosts'] ]) for hostgroup in result }
+
+
+def measure(name, build, reply, hostgroup_count, host_count, repeat):
+    gc.collect()
+    tracemalloc.start()
+
+    # Parsing the reply is part of both, like pyzabbix does it
+    hostgroups = build(json.loads(reply))
+    gc.collect()
+
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del hostgroups
+
+    seconds = min(timeit.repeat(lambda: build(json.loads(reply)), number=1, repeat=repeat))
+
+    # Per entity: everything kept (hosts, hostgroups and the dict by name)
+    # divided by the number of host entries, and by the number of hostgroups
+    print('%-6s %8.1f KiB kept %8.1f KiB peak %8.2f ms per request | per host %6.0f bytes %6.2f µs | per hostgroup %7.0f bytes %7.1f µs' % (
+            name, kept / 1024, peak / 1024, seconds * 1000,
+            kept / host_count, seconds / host_count * 1e6,
+            kept / hostgroup_count, seconds / hostgroup_count * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--hostgroups', type=int, default=500)
+    parser.add_argument('--hosts-per-group', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    reply = hostgroup_get_reply(args.hostgroups, args.hosts_per_group)
+
+    print('%s hostgroups with %s hosts each, %.1f KiB of JSON' % (args.hostgroups, args.hosts_per_group, len(reply) / 1024))
+    host_count = args.hostgroups * args.hosts_per_group
+    measure('dicts', build_dicts, reply, args.hostgroups, host_count, args.repeat)
+    measure('model', build_model, reply, args.hostgroups, host_count, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Dispatch time of the Router against telebot style handler lists, where every
+handler's filter is tried in turn until one matches.
+
+Registers --commands commands and --callbacks callback prefixes (half of them
+two words, like "graph host") and dispatches messages and callback queries
+spread over all of them:
+
+    python benchmarks/router_dispatch.py [--commands N] [--callbacks N]
+"""
+import argparse
+import os
+import sys
+import timeit
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telegram.router import Router, zabbix_id
+
+
+class FakeBot:
+    def reply_to(self, message, text):
+        pass
+
+    def answer_callback_query(self, callback_query_id, text = None):
+        pass
+
+
+def handler(update, *args):
+    pass
+
+
+def build_router(command_names, callback_prefixes):
+    router = Router(FakeBot(), { '1' })
+
+    for name in command_names:
+        router.command(name)(handler)
+
+    for prefix in callback_prefixes:
+        router.callback(prefix, zabbix_id, str, str)(handler)
+
+    return router
+
+
+def build_linear(command_names, callback_prefixes):
+    """
+    The handlers as telebot keeps them: (filter, handler) pairs, the filters
+    doing what the old func= lambdas did.
+    """
+    message_handlers = []
+    for name in command_names:
+        message_handlers.append((lambda message, name=name: message.text.lower().split(None, 1)[0].lstrip('/') == name, handler))
+
+    callback_handlers = []
+    for prefix in callback_prefixes:
+        callback_handlers.append((lambda cb, prefix=prefix: cb.data.startswith(prefix + ' '), handler))
+
+    def dispatch_message(message):
+        if str(message.from_user.id) not in { '1' }:
+            return
+
+        for check, message_handler in message_handlers:
+            if check(message):
+                message_handler(message)
+                return
+
+    def dispatch_callback(cb):
+        if str(cb.from_user.id) not in { '1' }:
+            return
+
+        # Two word prefixes are registered first, so "graph host" isn't
+        # taken for "graph"
+        for check, callback_handler in callback_handlers:
+            if check(cb):
+                words = cb.data.split(' ')
+                callback_handler(cb, *words[-3:])
+                return
+
+    return dispatch_message, dispatch_callback
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--commands', type=int, default=60)
+    parser.add_argument('--callbacks', type=int, default=60)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    command_names = [ 'command%s' % i for i in range(args.commands) ]
+    callback_prefixes = [ 'callback%s sub' % i for i in range(args.callbacks // 2) ] + \
+            [ 'callback%s' % i for i in range(args.callbacks - args.callbacks // 2) ]
+
+    user = types.SimpleNamespace(id=1)
+
+    # Every name once per round, so first and last handlers are equally represented
+    messages = [ types.SimpleNamespace(from_user=user, text='/%s some arguments' % name) for name in command_names ]
+    callbacks = [ types.SimpleNamespace(from_user=user, id='1', data='%s 1234 now-4h now' % prefix) for prefix in callback_prefixes ]
+
+    router = build_router(command_names, callback_prefixes)
+    linear_message, linear_callback = build_linear(command_names, callback_prefixes)
+
+    def run(dispatch, updates):
+        for update in updates:
+            dispatch(update)
+
+    print('%s commands, %s callback prefixes, time per dispatch:' % (len(command_names), len(callback_prefixes)))
+    for name, dispatch, updates in [
+            ( 'router message', router.dispatch_message, messages ),
+            ( 'linear message', linear_message, messages ),
+            ( 'router callback', router.dispatch_callback, callbacks ),
+            ( 'linear callback', linear_callback, callbacks ),
+    ]:
+        rounds = max(1, args.number // len(updates))
+        seconds = min(timeit.repeat(lambda: run(dispatch, updates), number=rounds, repeat=5))
+        print('%-16s %8.2f µs' % (name, seconds / (rounds * len(updates)) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,16 @@
+import concurrent.futures
+import html
 import logging
+import sys
 import telebot, telebot.types
 
 import zabbix_frontend
+import zabbix_frontend.resilience
+from zabbix_frontend.cache import LRUCache
+from telegram.items import ItemIndex, pattern_matches
+from telegram.model import Graph, Host, HostGroup
+from telegram.router import Router, zabbix_id
+from telegram.subscriptions import SubscriptionScheduler, validate_window
 
 
 #######################################################################
@@ -72,11 +81,101 @@ def calculate_graph_from_to_ts(from_ts, to_ts):
     }
 
 
+def graph_navigation_keyboard(callback_prefix, from_ts, to_ts):
+    """
+    Build the earlier/zoom out/refresh/zoom in/later keyboard for a graph
+    (or a set of graphs) shown from from_ts to to_ts.
+
+    The callback data of every button is callback_prefix followed by the new
+    from and to timestamps.
+    """
+    update_ts = calculate_graph_from_to_ts(from_ts, to_ts)
+
+    keyboard = telebot.types.InlineKeyboardMarkup()
+    keyboard.row_width = 5
+    keyboard.add(
+            telebot.types.InlineKeyboardButton("\u23ea", callback_data="%s %s %s" % (callback_prefix, update_ts['earlier_from'], update_ts['earlier_to'])),
+            telebot.types.InlineKeyboardButton("\U0001f50d\u2796", callback_data="%s %s %s" % (callback_prefix, update_ts['zoomout_from'], update_ts['zoomout_to'])),
+            telebot.types.InlineKeyboardButton("\U0001f504", callback_data="%s %s %s" % (callback_prefix, from_ts, to_ts)),
+            telebot.types.InlineKeyboardButton("\U0001f50d\u2795", callback_data="%s %s %s" % (callback_prefix, update_ts['zoomin_from'], update_ts['zoomin_to'])),
+            telebot.types.InlineKeyboardButton("\u23e9", callback_data="%s %s %s" % (callback_prefix, update_ts['later_from'], update_ts['later_to'])),
+    )
+
+    return keyboard
+
+
+def is_refresh_callback(cb):
+    """
+    Whether cb comes from the refresh button of a navigation keyboard, i.e.
+    asks for the window that is shown already.
+    """
+    keyboard = cb.message.reply_markup if cb.message is not None else None
+    if keyboard is None:
+        return False
+
+    return any(button.text == "\U0001f504" and button.callback_data == cb.data
+            for row in keyboard.keyboard for button in row)
+
+
+def graph_caption(from_ts, to_ts, title = 'Graph'):
+    return "%s from <b>%s</b> to <b>%s</b>" % (
+            title,
+            zabbix_frontend.epoch_to_absolute_time(zabbix_frontend.zabbix_time_to_epoch(from_ts)),
+            zabbix_frontend.epoch_to_absolute_time(zabbix_frontend.zabbix_time_to_epoch(to_ts)))
+
+
 class CommandHandler:
-    def __init__(self, telegram_token, zapi, telegram_users):
+    # Telegram allows at most 10 photos in one media group.
+    DASHBOARD_MAX_GRAPHS = 10
+
+    # Default maximum number of graphs fetched from the Zabbix frontend at
+    # the same time, over all dashboards being rendered. One full dashboard
+    # at a time, so a dashboard takes as long as its slowest graph.
+    GRAPH_FETCH_CONCURRENCY = DASHBOARD_MAX_GRAPHS
+
+    # Number of dashboards for which we remember the media group messages, so
+    # they can be updated in place when navigating.
+    DASHBOARD_ALBUMS_REMEMBERED = 1000
+
+    # Limits for /value, to keep both the Zabbix query and the reply small
+    VALUE_MAX_HOSTS = 50
+    VALUE_MAX_ITEMS = 50
+    VALUE_MAX_LENGTH = 100
+
+    # Telegram refuses messages longer than this
+    MESSAGE_MAX_LENGTH = 4096
+
+    # How long (in seconds) the hostgroups and hosts a user has access to
+    # are reused before asking Zabbix again, and for how many users.
+    HOSTGROUPS_CACHE_AGE = 60
+    HOSTGROUPS_CACHE_USERS = 100
+
+    def __init__(self, telegram_token, zapi, telegram_users, subscriptions_file = 'subscriptions.json', graph_warmer = None,
+            graph_fetch_concurrency = None):
         self.zapi = zapi
         self.telegram_users = telegram_users
 
+        self.graph_fetch_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers = graph_fetch_concurrency or self.GRAPH_FETCH_CONCURRENCY,
+                thread_name_prefix = 'graph-fetch')
+
+        # (chat id, navigation message id) -> [ media group message ids ]
+        self.dashboard_albums = LRUCache(self.DASHBOARD_ALBUMS_REMEMBERED)
+
+        self.item_index = ItemIndex(zapi)
+
+        # Built HostGroup objects per user (all super admins share one entry),
+        # shared by all handlers until they are HOSTGROUPS_CACHE_AGE old.
+        self.hostgroups_cache = LRUCache(self.HOSTGROUPS_CACHE_USERS)
+
+        # Optional zabbix_frontend.warming.GraphWarmer, told about every graph
+        # view so it can keep the popular ones rendered.
+        self.graph_warmer = graph_warmer
+
+        # Set by whoever knows how to reload the configuration; returns a
+        # list of lines describing what changed.
+        self.reload_config = None
+
         try:
             telebot.apihelper.ENABLE_MIDDLEWARE = True
             self.bot = telebot.TeleBot(telegram_token, parse_mode='HTML')
@@ -86,6 +185,11 @@ class CommandHandler:
 
         logging.info('Bot info from Telegram: %s', self.bot.get_me())
 
+        self.subscriptions = SubscriptionScheduler(self.bot, subscriptions_file,
+                # Rendered once and sent to many subscribers, so keep it in memory
+                lambda graph_id, from_ts, to_ts: zabbix_frontend.get_graph(graph_id, from_ts, to_ts, 1200, 400, stream=False),
+                graph_access = self.subscription_graph_access)
+
 
         #######################################################################
         # Message middleware handlers
@@ -97,40 +201,35 @@ class CommandHandler:
             logging.debug('********** Received message: %s', message)
 
 
-        ### Reject unknown senders
-        @self.bot.message_handler(func=lambda msg: str(msg.from_user.id) not in self.telegram_users)
-        def reject_unknown_senders(message):
-            self.bot.reply_to(message, "I don't know you. Go away")
-
-
-        ### Message text normalization
-        @self.bot.middleware_handler(update_types = ['message'])
-        def normalize_command(bot_instance, message):
-            message.text = message.text.lower()
-            if not message.text.startswith('/'):
-                logging.debug('Adding leading / to message [%s]', message.text)
-                message.text = '/' + message.text
-
-            logging.debug("+++ Final command: [%s]", message.text)
+        #######################################################################
+        # Message and callback query handlers
+        #
+        # Telebot only gets one handler for each; the router takes care of
+        # rejecting unknown senders, normalizing commands and finding the
+        # handler.
+        #######################################################################
+        self.router = Router(self.bot, self.telegram_users)
 
+        self.bot.register_message_handler(self.router.dispatch_message, func=lambda message: True)
+        self.bot.register_callback_query_handler(self.router.dispatch_callback, func=lambda cb: True)
 
 
         #######################################################################
         # Message handlers
         #######################################################################
-        @self.bot.message_handler(commands=['start'])
+        @self.router.command('start')
         def cmd_start(message):
             zabbix_user = self.telegram_users[str(message.from_user.id)]
             self.bot.reply_to(message,
-                     "Howdy <b>%s %s</b> (Zabbix username <b>%s</b>), how are you doing?" % (zabbix_user['first_name'], zabbix_user['surname'], zabbix_user['zabbix_username']))
+                     "Howdy <b>%s %s</b> (Zabbix username <b>%s</b>), how are you doing?" % (zabbix_user.first_name, zabbix_user.surname, zabbix_user.zabbix_username))
 
 
-        @self.bot.message_handler(commands=['help'])
+        @self.router.command('help')
         def cmd_help(message):
-            self.bot.reply_to(message, "Allowed commands: " + str(dir(self.__init__)))
+            self.bot.reply_to(message, "Allowed commands: " + ", ".join('/' + name for name in sorted(self.router.commands)))
 
 
-        @self.bot.message_handler(commands=['access'])
+        @self.router.command('access')
         def cmd_access(message):
             zabbix_user = self.telegram_users[str(message.from_user.id)]
 
@@ -182,17 +281,17 @@ class CommandHandler:
             reply = "You have access to these hosts:\n"
 
             for hostgroup in sorted(hosts_for_hostgroup):
-                hosts = hosts_for_hostgroup[hostgroup]['hosts']
+                hosts = hosts_for_hostgroup[hostgroup].hosts
 
                 reply += "\n<u>%s</u> (%s host(s))\n" % (hostgroup, len(hosts))
-                reply += "\n".join(sorted([ host['name'] for host in hosts], key=str.casefold))
+                reply += "\n".join(sorted([ host.name for host in hosts], key=str.casefold))
                 reply += "\n"
 
             self.bot.reply_to(message, reply)
 
 
 
-        @self.bot.message_handler(commands=['leftright'])
+        @self.router.command('leftright')
         def cmd_leftright(message):
             keyboard = telebot.types.InlineKeyboardMarkup()
             keyboard.row_width = 2
@@ -204,8 +303,8 @@ class CommandHandler:
             self.bot.reply_to(message, "Left... or right?", reply_markup = keyboard)
 
 
-        @self.bot.callback_query_handler(func=lambda cb: cb.data.startswith('leftright '))
-        def callback_leftright(cb):
+        @self.router.callback('leftright', str)
+        def callback_leftright(cb, direction):
             logging.debug("Callback: %s", cb)
 
             keyboard = telebot.types.InlineKeyboardMarkup()
@@ -215,13 +314,11 @@ class CommandHandler:
                     telebot.types.InlineKeyboardButton(">>", callback_data="leftright right")
             )
 
-            cb.data = cb.data[10:]  # Cut off "leftright " prefix
-
-            if cb.data == "left":
+            if direction == "left":
                 new_message = cb.message.text + "\nLeft!"
                 self.bot.edit_message_text(chat_id=cb.message.chat.id, message_id=cb.message.message_id, text=new_message, reply_markup = keyboard)
                 self.bot.answer_callback_query(cb.id, "Left")
-            elif cb.data == "right":
+            elif direction == "right":
                 new_message = cb.message.text + "\nRight!"
                 self.bot.edit_message_text(chat_id=cb.message.chat.id, message_id=cb.message.message_id, text=new_message, reply_markup = keyboard)
                 self.bot.answer_callback_query(cb.id, "Right")
@@ -229,32 +326,31 @@ class CommandHandler:
 
 
         ### Graphs
-        @self.bot.message_handler(commands=['graph'])
+        @self.router.command('graph')
         def cmd_graph(message):
             zabbix_user = self.telegram_users[str(message.from_user.id)]
             hosts_for_hostgroup = self.get_hostgroups_hosts_for_user(zabbix_user)
 
-            cust_hostgroups = { hostgroup: hosts for hostgroup, hosts in hosts_for_hostgroup.items() if (hostgroup.startswith('Customers/') and len(hosts) > 0) }
+            cust_hostgroups = { name: hostgroup for name, hostgroup in hosts_for_hostgroup.items() if (name.startswith('Customers/') and len(hostgroup.hosts) > 0) }
 
             keyboard = telebot.types.InlineKeyboardMarkup()
             keyboard.row_width = 1
 
             for hostgroup in sorted(cust_hostgroups):
-                hosts = cust_hostgroups[hostgroup]['hosts']
+                hosts = cust_hostgroups[hostgroup].hosts
 
                 keyboard.add(
                         telebot.types.InlineKeyboardButton(
-                            hostgroup + " (" + str(len(hosts)) + " host(s))", callback_data="graph hostgroup " + cust_hostgroups[hostgroup]['id'])
+                            hostgroup + " (" + str(len(hosts)) + " host(s))", callback_data="graph hostgroup " + cust_hostgroups[hostgroup].id)
                 )
 
             self.bot.reply_to(message, "Choose a hostgroup.", reply_markup = keyboard)
 
 
-        @self.bot.callback_query_handler(func=lambda cb: cb.data.startswith('graph hostgroup '))
-        def callback_graph_select_host_from_hostgroup(cb):
+        @self.router.callback('graph hostgroup', zabbix_id)
+        def callback_graph_select_host_from_hostgroup(cb, hostgroup_id):
             logging.debug("Callback: %s", cb)
 
-            hostgroup_id = cb.data.split(' ')[2]
             hosts_zbx = self.zapi.host.get(
                     groupids = hostgroup_id,
                     selectGraphs = [ 'id' ],
@@ -264,14 +360,11 @@ class CommandHandler:
 
             hosts_with_graphcount = {}
             for host_zbx in hosts_zbx:
-                hosts_with_graphcount[host_zbx['name']] = {
-                        'id': host_zbx['hostid'],
-                        'graphcount': len(host_zbx['graphs'])
-                }
+                hosts_with_graphcount[host_zbx['name']] = Host(host_zbx['hostid'], host_zbx['name'], len(host_zbx['graphs']))
 
             new_text = 'Selected hostgroup: <b>%s</b>.\n\nPlease choose a host.' % hosts_zbx[0]['hostgroups'][0]['name']
 
-            hosts_with_graphs = { host: data for host, data in hosts_with_graphcount.items() if data['graphcount'] > 0 }
+            hosts_with_graphs = { name: host for name, host in hosts_with_graphcount.items() if host.graphcount > 0 }
 
             keyboard = telebot.types.InlineKeyboardMarkup()
             keyboard.row_width = 1
@@ -281,18 +374,17 @@ class CommandHandler:
 
                 keyboard.add(
                         telebot.types.InlineKeyboardButton(
-                            host_with_graphs + " (" + str(host_data['graphcount']) + " graph(s))", callback_data="graph host " + host_data['id'])
+                            host_with_graphs + " (" + str(host_data.graphcount) + " graph(s))", callback_data="graph host " + host_data.id)
                 )
 
             self.bot.edit_message_text(chat_id=cb.message.chat.id, message_id=cb.message.message_id, text=new_text, reply_markup = keyboard)
             self.bot.answer_callback_query(cb.id, "You have selected hostgroup " + hosts_zbx[0]['hostgroups'][0]['name'])
 
 
-        @self.bot.callback_query_handler(func=lambda cb: cb.data.startswith('graph host '))
-        def callback_graph_select_graph_from_host(cb):
+        @self.router.callback('graph host', zabbix_id)
+        def callback_graph_select_graph_from_host(cb, host_id):
             logging.debug("Callback: %s", cb)
 
-            host_id = cb.data.split(' ')[2]
             graphs_zbx = self.zapi.graph.get(
                     hostids = host_id,
                     selectHosts = [ 'name' ],
@@ -301,13 +393,13 @@ class CommandHandler:
 
             new_text = 'Selected host: <b>%s</b>.\n\nPlease select a graph.' % graphs_zbx[0]['hosts'][0]['name']
 
-            graphs = { graph['name']: { 'id': graph['graphid'] } for graph in graphs_zbx }
+            graphs = { graph['name']: Graph(graph['graphid'], graph['name']) for graph in graphs_zbx }
 
             keyboard = telebot.types.InlineKeyboardMarkup()
             keyboard.row_width = 1
 
             for graph in sorted(graphs):
-                graph_id = graphs[graph]['id']
+                graph_id = graphs[graph].id
 
                 keyboard.add(telebot.types.InlineKeyboardButton(
                     graph, callback_data="graph graphid " + graph_id
@@ -317,31 +409,18 @@ class CommandHandler:
             self.bot.answer_callback_query(cb.id, "You have selected host " + graphs_zbx[0]['hosts'][0]['name'])
 
 
-        @self.bot.callback_query_handler(func=lambda cb: cb.data.startswith('graph graphid '))
-        def callback_graph_show_graph_with_graphid(cb):
+        @self.router.callback('graph graphid', zabbix_id)
+        def callback_graph_show_graph_with_graphid(cb, graph_id):
             logging.debug("Callback: %s", cb)
 
-            data = cb.data.split(' ')
-            graph_id = data[2]
-
             from_ts = 'now-4h'
             to_ts = 'now'
 
 
             self.bot.send_chat_action(cb.message.chat.id, 'upload_photo')
-            graph = zabbix_frontend.get_graph(graph_id, from_ts, to_ts, 1200, 400)
+            graph = self.get_graph(graph_id, from_ts, to_ts)
 
-            update_ts = calculate_graph_from_to_ts(from_ts, to_ts)
-
-            keyboard = telebot.types.InlineKeyboardMarkup()
-            keyboard.row_width = 5
-            keyboard.add(
-                    telebot.types.InlineKeyboardButton("\u23ea", callback_data="graph redraw %s %s %s" % (graph_id, update_ts['earlier_from'], update_ts['earlier_to'])),
-                    telebot.types.InlineKeyboardButton("\U0001f50d\u2796", callback_data="graph redraw %s %s %s" % (graph_id, update_ts['zoomout_from'], update_ts['zoomout_to'])),
-                    telebot.types.InlineKeyboardButton("\U0001f504", callback_data="graph redraw %s %s %s" % (graph_id, from_ts, to_ts)),
-                    telebot.types.InlineKeyboardButton("\U0001f50d\u2795", callback_data="graph redraw %s %s %s" % (graph_id, update_ts['zoomin_from'], update_ts['zoomin_to'])),
-                    telebot.types.InlineKeyboardButton("\u23e9", callback_data="graph redraw %s %s %s" % (graph_id, update_ts['later_from'], update_ts['later_to'])),
-            )
+            keyboard = graph_navigation_keyboard('graph redraw ' + graph_id, from_ts, to_ts)
 
             # It is not possible to change the media type of an already sent
             # message (text to photo), so we'll have to delete the original
@@ -349,9 +428,7 @@ class CommandHandler:
             self.bot.send_photo(cb.message.chat.id,
                     reply_to_message_id=cb.message.reply_to_message.message_id,
                     photo=graph,
-                    caption="Graph from <b>%s</b> to <b>%s</b>" % (
-                        zabbix_frontend.epoch_to_absolute_time(zabbix_frontend.zabbix_time_to_epoch(from_ts)),
-                        zabbix_frontend.epoch_to_absolute_time(zabbix_frontend.zabbix_time_to_epoch(to_ts))),
+                    caption=graph_caption(from_ts, to_ts),
                     reply_markup=keyboard
             )
             self.bot.delete_message(chat_id=cb.message.chat.id, message_id=cb.message.message_id)
@@ -363,51 +440,255 @@ class CommandHandler:
             self.bot.answer_callback_query(cb.id, "Your graph should be there")
 
 
-        @self.bot.callback_query_handler(func=lambda cb: cb.data.startswith('graph redraw '))
-        def callback_redraw_graph_with_graphid(cb):
+        @self.router.callback('graph redraw', zabbix_id, str, str)
+        def callback_redraw_graph_with_graphid(cb, graph_id, from_ts, to_ts):
             logging.debug("Callback: %s", cb)
 
-            data = cb.data.split(' ')
-            graph_id = data[2]
-            from_ts = data[3]
-            to_ts = data[4]
-
             self.bot.send_chat_action(cb.message.chat.id, 'upload_photo')
-            graph = zabbix_frontend.get_graph(graph_id, from_ts, to_ts, 1200, 400)
+            graph = self.get_graph(graph_id, from_ts, to_ts, refresh=is_refresh_callback(cb))
 
-            update_ts = calculate_graph_from_to_ts(from_ts, to_ts)
-
-            keyboard = telebot.types.InlineKeyboardMarkup()
-            keyboard.row_width = 5
-            keyboard.add(
-                    telebot.types.InlineKeyboardButton("\u23ea", callback_data="graph redraw %s %s %s" % (graph_id, update_ts['earlier_from'], update_ts['earlier_to'])),
-                    telebot.types.InlineKeyboardButton("\U0001f50d\u2796", callback_data="graph redraw %s %s %s" % (graph_id, update_ts['zoomout_from'], update_ts['zoomout_to'])),
-                    telebot.types.InlineKeyboardButton("\U0001f504", callback_data="graph redraw %s %s %s" % (graph_id, from_ts, to_ts)),
-                    telebot.types.InlineKeyboardButton("\U0001f50d\u2795", callback_data="graph redraw %s %s %s" % (graph_id, update_ts['zoomin_from'], update_ts['zoomin_to'])),
-                    telebot.types.InlineKeyboardButton("\u23e9", callback_data="graph redraw %s %s %s" % (graph_id, update_ts['later_from'], update_ts['later_to'])),
-            )
+            keyboard = graph_navigation_keyboard('graph redraw ' + graph_id, from_ts, to_ts)
 
             self.bot.edit_message_media(chat_id=cb.message.chat.id,
                     message_id=cb.message.message_id,
                     media=telebot.types.InputMediaPhoto(graph,
-                        caption="Graph from <b>%s</b> to <b>%s</b>" % (
-                            zabbix_frontend.epoch_to_absolute_time(zabbix_frontend.zabbix_time_to_epoch(from_ts)),
-                            zabbix_frontend.epoch_to_absolute_time(zabbix_frontend.zabbix_time_to_epoch(to_ts))),
+                        caption=graph_caption(from_ts, to_ts),
                         parse_mode='HTML'),
                     reply_markup=keyboard
             )
             self.bot.answer_callback_query(cb.id, "Done")
 
 
+        ### Dashboards
+        @self.router.command('dashboard')
+        def cmd_dashboard(message):
+            zabbix_user = self.telegram_users[str(message.from_user.id)]
+
+            args = message.text.split(' ', 1)
+            name = args[1].strip() if len(args) > 1 else ''
+            if name == '':
+                self.bot.reply_to(message, "Usage: /dashboard &lt;host or dashboard name&gt;")
+                return
+
+            target = self.find_dashboard_target(zabbix_user, name)
+            if target is None:
+                self.bot.reply_to(message, "No host or dashboard <b>%s</b> found." % html.escape(name))
+                return
+
+            kind, target_id = target
+            self.send_dashboard(message.chat.id, zabbix_user, kind, target_id, 'now-4h', 'now', reply_to_message_id=message.message_id)
+
+
+        @self.router.callback('dashboard redraw', str, zabbix_id, str, str)
+        def callback_redraw_dashboard(cb, kind, target_id, from_ts, to_ts):
+            logging.debug("Callback: %s", cb)
+
+            zabbix_user = self.telegram_users[str(cb.from_user.id)]
+
+            self.send_dashboard(cb.message.chat.id, zabbix_user, kind, target_id, from_ts, to_ts, navigation_message=cb.message,
+                    refresh=is_refresh_callback(cb))
+            self.bot.answer_callback_query(cb.id, "Done")
+
+
+        ### Subscriptions
+        @self.router.command('subscribe')
+        def cmd_subscribe(message):
+            zabbix_user = self.telegram_users[str(message.from_user.id)]
+
+            # /subscribe <graph ID> <5 cron fields> <window>
+            args = message.text.split()[1:]
+            if len(args) != 7:
+                self.bot.reply_to(message,
+                        "Usage: /subscribe &lt;graph ID&gt; &lt;cron schedule&gt; &lt;window&gt;\n\n"
+                        "For example <code>/subscribe 1234 0 8 * * 1-5 1d</code> sends the last day of graph 1234 "
+                        "every weekday at 8:00. The graph ID is the graphid in the Zabbix frontend URL.\n\n"
+                        "The window is a number with a unit: h (hours), d (days), w (weeks), mo (months) "
+                        "or y (years), or m (minutes) for at least 5 minutes.")
+                return
+
+            graph_id = args[0]
+            schedule = ' '.join(args[1:6])
+
+            try:
+                window = validate_window(args[6])
+            except ValueError as e:
+                self.bot.reply_to(message, html.escape(str(e)))
+                return
+
+            graph = self.get_graph_for_user(zabbix_user, graph_id)
+            if graph is None:
+                self.bot.reply_to(message, "Unknown graph %s." % html.escape(graph_id))
+                return
+
+            try:
+                subscription = self.subscriptions.add(message.from_user.id, message.chat.id,
+                        graph.id, graph.name, schedule, window)
+            except ValueError as e:
+                self.bot.reply_to(message, html.escape(str(e)))
+                return
+
+            self.bot.reply_to(message, "Subscribed to <b>%s</b> (subscription %s), next delivery at %s." % (
+                    html.escape(subscription.graph_name), subscription.id,
+                    zabbix_frontend.epoch_to_absolute_time(subscription.next_fire)))
+
+
+        @self.router.command('subscriptions')
+        def cmd_subscriptions(message):
+            subscriptions = self.subscriptions.subscriptions_for(message.from_user.id)
+
+            if len(subscriptions) == 0:
+                self.bot.reply_to(message, "You have no subscriptions.")
+                return
+
+            reply = "Your subscriptions:\n"
+            for subscription in sorted(subscriptions, key=lambda subscription: subscription.id):
+                reply += "\n%s: <b>%s</b>, last %s at <code>%s</code>" % (
+                        subscription.id, html.escape(subscription.graph_name), subscription.window, subscription.schedule)
+
+            self.bot.reply_to(message, reply)
+
+
+        @self.router.command('unsubscribe')
+        def cmd_unsubscribe(message):
+            args = message.text.split()[1:]
+            if len(args) != 1 or not args[0].isdigit():
+                self.bot.reply_to(message, "Usage: /unsubscribe &lt;subscription ID&gt;. Try /subscriptions.")
+                return
+
+            if self.subscriptions.remove(int(args[0]), message.from_user.id):
+                self.bot.reply_to(message, "Unsubscribed.")
+            else:
+                self.bot.reply_to(message, "You have no subscription %s." % args[0])
+
+
+        ### Latest values
+        @self.router.command('value')
+        def cmd_value(message):
+            zabbix_user = self.telegram_users[str(message.from_user.id)]
+
+            args = message.text.split(None, 2)
+            if len(args) < 3:
+                self.bot.reply_to(message,
+                        "Usage: /value &lt;host&gt; &lt;item pattern&gt;\n\n"
+                        "The host can contain wildcards, e.g. <code>/value web* cpu utilization</code>. "
+                        "The item pattern is matched against item names and keys.")
+                return
+
+            host_pattern = args[1]
+            item_pattern = args[2].strip()
+
+            # Only hosts the user has access to
+            hosts = {}
+            for hostgroup in self.get_hostgroups_hosts_for_user(zabbix_user).values():
+                for host in hostgroup.hosts:
+                    if host.name.casefold() == host_pattern.casefold() or (any(c in host_pattern for c in '*?[') and pattern_matches(host_pattern, host.name)):
+                        hosts[host.id] = host
+
+            if len(hosts) == 0:
+                self.bot.reply_to(message, "No host <b>%s</b> found." % html.escape(host_pattern))
+                return
+
+            if len(hosts) > self.VALUE_MAX_HOSTS:
+                self.bot.reply_to(message, "%s hosts match <b>%s</b>, please be more specific." % (len(hosts), html.escape(host_pattern)))
+                return
+
+            items = self.item_index.find_items(list(hosts), item_pattern)
+            if len(items) == 0:
+                self.bot.reply_to(message, "No items matching <b>%s</b> found." % html.escape(item_pattern))
+                return
+
+            items.sort(key=lambda item: (hosts[item.host_id].name.casefold(), item.name.casefold()))
+
+            reply = ""
+            if len(items) > self.VALUE_MAX_ITEMS:
+                reply += "Showing the first %s of %s items.\n" % (self.VALUE_MAX_ITEMS, len(items))
+                items = items[:self.VALUE_MAX_ITEMS]
+
+            values = self.item_index.latest_values(items)
+
+            current_host_id = None
+            for index, item in enumerate(items):
+                line = ""
+                if item.host_id != current_host_id:
+                    line += "\n<u>%s</u>\n" % html.escape(hosts[item.host_id].name)
+
+                lastvalue, lastclock = values.get(item.id, ('', 0))
+                if len(lastvalue) > self.VALUE_MAX_LENGTH:
+                    lastvalue = lastvalue[:self.VALUE_MAX_LENGTH] + '…'
+
+                if lastclock == 0:
+                    line += "%s: <i>no data</i>\n" % html.escape(item.name)
+                else:
+                    line += "%s: <b>%s</b> (%s)\n" % (
+                            html.escape(item.name),
+                            html.escape((lastvalue + ' ' + item.units).strip()),
+                            zabbix_frontend.epoch_to_absolute_time(lastclock))
+
+                # Leave room for the "more" line
+                if len(reply) + len(line) > self.MESSAGE_MAX_LENGTH - 32:
+                    reply += "\n… %s more" % (len(items) - index)
+                    break
+
+                reply += line
+                current_host_id = item.host_id
+
+            self.bot.reply_to(message, reply)
+
+
+        ### Status
+        @self.router.command('status')
+        def cmd_status(message):
+            zabbix_user = self.telegram_users[str(message.from_user.id)]
+            if not zabbix_user.is_superadmin:
+                self.bot.reply_to(message, "Only super admins can see the bot status.")
+                return
+
+            reply = "<u>Circuit breakers</u>\n"
+            for name, stats in sorted(zabbix_frontend.resilience.stats().items()):
+                reply += "\n<b>%s</b>: %s\n" % (name, stats['state'])
+                reply += "%s call(s), %s failure(s), %s rejected, opened %s time(s)\n" % (
+                        stats['calls'], stats['failures'], stats['rejected'], stats['opened'])
+
+            reply += "\n<u>Caches</u>\n"
+            reply += "\nGraphs: %s entries\n" % len(zabbix_frontend.graph_cache)
+            if isinstance(self.zapi, zabbix_frontend.resilience.ResilientZabbixAPI):
+                reply += "API results: %s entries\n" % len(self.zapi.cache)
+
+            if self.graph_warmer is not None:
+                stats = self.graph_warmer.stats()
+                reply += "\n<u>Graph warming</u>\n"
+                reply += "\n%s view(s), %s warm hit(s) (%.0f%%)\n" % (stats['views'], stats['warm_hits'], stats['warm_hit_ratio'] * 100)
+                reply += "%s render(s), %s failure(s), over budget %s time(s)\n" % (
+                        stats['renders'], stats['render_failures'], stats['over_budget'])
+
+            self.bot.reply_to(message, reply)
+
+
+        ### Configuration reload
+        @self.router.command('reload')
+        def cmd_reload(message):
+            zabbix_user = self.telegram_users[str(message.from_user.id)]
+            if not zabbix_user.is_superadmin:
+                self.bot.reply_to(message, "Only super admins can reload the configuration.")
+                return
+
+            if self.reload_config is None:
+                self.bot.reply_to(message, "Reloading the configuration is not supported.")
+                return
+
+            report = self.reload_config()
+            self.bot.reply_to(message, html.escape("\n".join(report)))
+
+
         ### Sst, easter egg :)
-        @self.bot.message_handler(commands=['💩'])
+        @self.router.command('💩')
         def cmd_pile_of_poo(message):
             self.bot.reply_to(message, "ZBXHIT is da shit!")
 
 
 
         ### Fallback handler - unknown command
-        @self.bot.message_handler(func=lambda message: True)
+        @self.router.fallback_command
         def fallback_handler(message):
             self.bot.reply_to(message, "Unknown command %s. Try /help." % message.text)
 
@@ -416,9 +697,43 @@ class CommandHandler:
 
 
     def get_hostgroups_hosts_for_user(self, zabbix_user):
+        """
+        Hostgroups (by name) the user has access to, with their hosts.
+
+        The result is cached for a short while and shared between requests,
+        so callers must not modify it.
+        """
+        return self._get_access_for_user(zabbix_user)[0]
+
+
+    def get_host_ids_for_user(self, zabbix_user):
+        """
+        Frozenset of the ID's of all hosts the user has access to, cached
+        like get_hostgroups_hosts_for_user().
+        """
+        return self._get_access_for_user(zabbix_user)[1]
+
+
+    def _get_access_for_user(self, zabbix_user):
+        cache_key = 'superadmin' if zabbix_user.is_superadmin else zabbix_user.zabbix_userid
+
+        cached = self.hostgroups_cache.get(cache_key, max_age=self.HOSTGROUPS_CACHE_AGE)
+        if cached is not None:
+            return cached[1]
+
+        hosts_for_hostgroup = self._fetch_hostgroups_hosts_for_user(zabbix_user)
+        host_ids = frozenset().union(*(hostgroup.host_ids() for hostgroup in hosts_for_hostgroup.values()))
+
+        access = (hosts_for_hostgroup, host_ids)
+        self.hostgroups_cache.put(cache_key, access)
+
+        return access
+
+
+    def _fetch_hostgroups_hosts_for_user(self, zabbix_user):
         hostgroups = []
 
-        if zabbix_user['is_superadmin']:
+        if zabbix_user.is_superadmin:
             # Super admins have implicit access to all hostgroups.
             # Unfortunately the logic used for non-superadmins below
             # doesn't work here: using selectHostGroupRights only returns
@@ -441,7 +756,7 @@ class CommandHandler:
             #   ]
             # }
             usergroups_with_rights = self.zapi.usergroup.get(
-                    userids = zabbix_user['zabbix_userid'],
+                    userids = zabbix_user.zabbix_userid,
                     selectHostGroupRights = [ 'id', 'permission' ],
                     output = 'usrgrpid',
             )
@@ -469,12 +784,9 @@ class CommandHandler:
 
         hosts_for_hostgroup = {}
         for hostgroup in hostgroups_with_hosts:
-            hosts = [ { 'id': host['hostid'], 'name': host['name'] } for host in hostgroup['hosts'] ]
+            hosts = [ Host(host['hostid'], host['name']) for host in hostgroup['hosts'] ]
 
-            hosts_for_hostgroup[hostgroup['name']] = {
-                    'id': hostgroup['groupid'],
-                    'hosts': hosts,
-            }
+            hosts_for_hostgroup[hostgroup['name']] = HostGroup(hostgroup['groupid'], hostgroup['name'], hosts)
 
         logging.debug("--- Hosts for hostsgroup: %s", hosts_for_hostgroup)
 
@@ -482,5 +794,288 @@ class CommandHandler:
 
 
 
+    def get_graph_with_host_ids(self, graph_id):
+        """
+        The graph with graph_id and a frozenset of the ID's of its hosts, or
+        (None, None) if it doesn't exist.
+        """
+        if not graph_id.isdigit():
+            return (None, None)
+
+        graphs_zbx = self.zapi.graph.get(
+                graphids = graph_id,
+                selectHosts = [ 'hostid' ],
+                output = [ 'graphid', 'name' ],
+        )
+
+        if len(graphs_zbx) == 0:
+            return (None, None)
+
+        return (Graph(graphs_zbx[0]['graphid'], graphs_zbx[0]['name']), frozenset(host['hostid'] for host in graphs_zbx[0]['hosts']))
+
+
+    def get_graph_for_user(self, zabbix_user, graph_id):
+        """
+        The graph with graph_id, or None if it doesn't exist or the user has
+        no access to all of its hosts.
+        """
+        graph, graph_host_ids = self.get_graph_with_host_ids(graph_id)
+        if graph is None or not graph_host_ids <= self.get_host_ids_for_user(zabbix_user):
+            return None
+
+        return graph
+
+
+    def subscription_graph_access(self, graph_id):
+        """
+        For the subscription scheduler: look up the graph's hosts once, and
+        return a function telling whether a subscriber is still a known user
+        with access to all of them.
+        """
+        graph, graph_host_ids = self.get_graph_with_host_ids(graph_id)
+        if graph is None:
+            return lambda telegram_user_id: False
+
+        def may_receive(telegram_user_id):
+            zabbix_user = self.telegram_users.get(telegram_user_id)
+            return zabbix_user is not None and graph_host_ids <= self.get_host_ids_for_user(zabbix_user)
+
+        return may_receive
+
+
+    def find_dashboard_target(self, zabbix_user, name):
+        """
+        Find the host or Zabbix dashboard called name, hosts first.
+
+        The command text has been lowercased by the time we get here, so an
+        exact case-insensitive match wins; otherwise a partial match is only
+        accepted if it is unambiguous.
+
+        Returns a tuple (kind, id), with kind 'h' for a host and 'd' for a
+        dashboard, or None if nothing matched.
+        """
+        allowed_host_ids = self.get_host_ids_for_user(zabbix_user)
+
+        hosts_zbx = self.zapi.host.get(
+                search = { 'name': name },
+                output = [ 'hostid', 'name' ],
+        )
+        hosts_zbx = [ host for host in hosts_zbx if host['hostid'] in allowed_host_ids ]
+
+        dashboards_zbx = self.zapi.dashboard.get(
+                search = { 'name': name },
+                output = [ 'dashboardid', 'name' ],
+        )
+
+        for kind, id_field, candidates in [
+            ( 'h', 'hostid', hosts_zbx ),
+            ( 'd', 'dashboardid', dashboards_zbx ),
+        ]:
+            exact = [ candidate for candidate in candidates if candidate['name'].casefold() == name.casefold() ]
+            if len(exact) > 0:
+                return (kind, exact[0][id_field])
+
+        for kind, id_field, candidates in [
+            ( 'h', 'hostid', hosts_zbx ),
+            ( 'd', 'dashboardid', dashboards_zbx ),
+        ]:
+            if len(candidates) == 1:
+                return (kind, candidates[0][id_field])
+
+        return None
+
+
+    def get_dashboard_graphs_for_user(self, zabbix_user, kind, target_id):
+        """
+        Get the graphs of a host (kind 'h') or of the graph widgets on a Zabbix
+        dashboard (kind 'd'). Graphs on hosts the user has no access to are
+        left out.
+
+        Returns a tuple (title, graphs).
+        """
+        allowed_host_ids = self.get_host_ids_for_user(zabbix_user)
+
+        title = None
+        graphs_zbx = []
+
+        if kind == 'h':
+            if target_id not in allowed_host_ids:
+                return (title, [])
+
+            graphs_zbx = self.zapi.graph.get(
+                    hostids = target_id,
+                    selectHosts = [ 'hostid', 'name' ],
+                    output = [ 'graphid', 'name' ],
+            )
+            graphs_zbx.sort(key=lambda graph: graph['name'].casefold())
+
+            if len(graphs_zbx) > 0:
+                title = graphs_zbx[0]['hosts'][0]['name']
+        elif kind == 'd':
+            dashboards_zbx = self.zapi.dashboard.get(
+                    dashboardids = target_id,
+                    selectPages = 'extend',
+                    output = [ 'dashboardid', 'name' ],
+            )
+            if len(dashboards_zbx) == 0:
+                return (title, [])
+
+            title = dashboards_zbx[0]['name']
+
+            graph_ids = []
+            for page in dashboards_zbx[0]['pages']:
+                for widget in page['widgets']:
+                    if widget['type'] != 'graph':
+                        continue
+
+                    for field in widget['fields']:
+                        # The field is called "graphid" up to Zabbix 6.2 and
+                        # "graphid.0" as of Zabbix 6.4.
+                        if field['name'].split('.')[0] == 'graphid' and field['value'] not in graph_ids:
+                            graph_ids.append(field['value'])
+
+            if len(graph_ids) > 0:
+                graphs_zbx = self.zapi.graph.get(
+                        graphids = graph_ids,
+                        selectHosts = [ 'hostid' ],
+                        output = [ 'graphid', 'name' ],
+                )
+
+                # Keep the order of the widgets on the dashboard
+                graphs_zbx.sort(key=lambda graph: graph_ids.index(graph['graphid']))
+
+        graphs = [ Graph(graph['graphid'], graph['name']) for graph in graphs_zbx
+                if all(host['hostid'] in allowed_host_ids for host in graph['hosts']) ]
+
+        return (title, graphs)
+
+
+    def get_graph(self, graph_id, from_ts, to_ts, width = 1200, height = 400, refresh = False):
+        if self.graph_warmer is not None:
+            self.graph_warmer.record_view(graph_id, from_ts, to_ts, width, height)
+
+        return zabbix_frontend.get_graph(graph_id, from_ts, to_ts, width, height, refresh=refresh)
+
+
+    def fetch_graphs(self, graphs, from_ts, to_ts, width = 1200, height = 400, refresh = False):
+        """
+        Fetch several graphs at once, on the shared graph fetch pool.
+
+        As long as the pool has a free worker for every graph, the total time
+        is that of the slowest graph instead of the sum. When several
+        dashboards are rendered at the same time, graphs wait for a worker,
+        which keeps the load on the Zabbix frontend bounded.
+
+        Returns a list of (image, error) in the order of graphs: a graph that
+        couldn't be fetched has image None and the exception as error.
+        """
+        futures = { self.graph_fetch_pool.submit(self.get_graph, graph.id, from_ts, to_ts, width, height, refresh): index
+                for index, graph in enumerate(graphs) }
+
+        results = [ None ] * len(graphs)
+        for future in concurrent.futures.as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = (future.result(), None)
+            except Exception as e:
+                logging.warning('Fetching graph %s failed: %s', graphs[index].id, e)
+                results[index] = (None, e)
+
+        return results
+
+
+    def send_dashboard(self, chat_id, zabbix_user, kind, target_id, from_ts, to_ts, reply_to_message_id = None, navigation_message = None,
+            refresh = False):
+        """
+        Send the graphs of a host or Zabbix dashboard as one media group,
+        followed by a message with the navigation keyboard.
+
+        A media group can't have a keyboard, hence the separate message. When
+        navigation_message is given, the media group belonging to it is
+        updated in place.
+
+        A media group needs at least 2 photos, so a single graph is sent as
+        one photo with the keyboard instead; then that photo is the
+        navigation message.
+        """
+        title, graphs = self.get_dashboard_graphs_for_user(zabbix_user, kind, target_id)
+
+        if len(graphs) == 0:
+            text = "No graphs to show."
+            if navigation_message is not None:
+                self.bot.edit_message_text(chat_id=chat_id, message_id=navigation_message.message_id, text=text)
+            else:
+                self.bot.send_message(chat_id, text, reply_to_message_id=reply_to_message_id)
+            return
+
+        text = graph_caption(from_ts, to_ts, title="Dashboard <b>%s</b>" % html.escape(title))
+        if len(graphs) > self.DASHBOARD_MAX_GRAPHS:
+            text += "\n\nShowing the first %s of %s graphs." % (self.DASHBOARD_MAX_GRAPHS, len(graphs))
+            graphs = graphs[:self.DASHBOARD_MAX_GRAPHS]
+
+        self.bot.send_chat_action(chat_id, 'upload_photo')
+        results = self.fetch_graphs(graphs, from_ts, to_ts, refresh=refresh)
+
+        failed = [ graph for graph, (image, error) in zip(graphs, results) if error is not None ]
+        if len(failed) == len(graphs):
+            # Nothing to show; let the router tell why
+            raise results[0][1]
+
+        if len(failed) > 0:
+            text += "\n\nCould not render: %s." % ', '.join(html.escape(graph.name) for graph in failed)
+
+        rendered = [ (graph, image) for graph, (image, error) in zip(graphs, results) if error is None ]
+        keyboard = graph_navigation_keyboard('dashboard redraw %s %s' % (kind, target_id), from_ts, to_ts)
+
+        if len(rendered) == 1:
+            graph, image = rendered[0]
+            text = "<b>%s</b>\n%s" % (html.escape(graph.name), text)
+            media = [ telebot.types.InputMediaPhoto(image, caption=text, parse_mode='HTML') ]
+        else:
+            media = [ telebot.types.InputMediaPhoto(image, caption=html.escape(graph.name), parse_mode='HTML')
+                    for graph, image in rendered ]
+
+        # Media group message ids of the navigation message; empty when the
+        # navigation message is the only photo.
+        album_message_ids = None
+        if navigation_message is not None:
+            album = self.dashboard_albums.get((chat_id, navigation_message.message_id))
+            if album is not None:
+                album_message_ids = album[1]
+
+        if album_message_ids is not None and len(media) == 1 and len(album_message_ids) == 0:
+            self.bot.edit_message_media(chat_id=chat_id, message_id=navigation_message.message_id, media=media[0], reply_markup=keyboard)
+            return
+
+        if album_message_ids is not None and len(media) > 1 and len(album_message_ids) == len(media):
+            for message_id, photo in zip(album_message_ids, media):
+                self.bot.edit_message_media(chat_id=chat_id, message_id=message_id, media=photo)
+
+            self.bot.edit_message_text(chat_id=chat_id, message_id=navigation_message.message_id, text=text, reply_markup=keyboard)
+            return
+
+        # New dashboard, another number of graphs than before, or we don't
+        # know (anymore) which media group belongs to this navigation
+        # message: send everything again.
+        if len(media) == 1:
+            navigation = self.bot.send_photo(chat_id, rendered[0][1], caption=text, reply_markup=keyboard, reply_to_message_id=reply_to_message_id)
+            album = []
+        else:
+            album = self.bot.send_media_group(chat_id, media, reply_to_message_id=reply_to_message_id)
+            navigation = self.bot.send_message(chat_id, text, reply_markup=keyboard)
+
+        if navigation_message is not None:
+            for message_id in (album_message_ids or []) + [ navigation_message.message_id ]:
+                try:
+                    self.bot.delete_message(chat_id=chat_id, message_id=message_id)
+                except telebot.apihelper.ApiTelegramException as e:
+                    # E.g. messages older than 48 hours can't be deleted
+                    logging.warning('Deleting old dashboard message %s failed: %s', message_id, e)
+
+        self.dashboard_albums.put((chat_id, navigation.message_id), [ message.message_id for message in album ])
+
+
+
     def start_polling(self):
+        self.subscriptions.start()
         self.bot.infinity_polling()
@@ -0,0 +1,109 @@
+import fnmatch
+import logging
+import threading
+import time
+
+from telegram.model import Item
+
+
+def pattern_matches(pattern, *values):
+    """
+    Case-insensitive match of pattern against any of values. Patterns with
+    shell wildcards (*, ?, [...]) are matched as such, anything else is a
+    substring match.
+    """
+    pattern = pattern.casefold()
+    wildcard = any(c in pattern for c in '*?[')
+
+    for value in values:
+        value = value.casefold()
+        if wildcard and fnmatch.fnmatchcase(value, pattern):
+            return True
+        if not wildcard and pattern in value:
+            return True
+
+    return False
+
+
+class ItemIndex:
+    """
+    Per host list of monitored items, so looking up items by name doesn't
+    need an item.get on every request.
+
+    A host's items are refreshed when they are older than max_age seconds.
+    Only the stale hosts are fetched, all of them in a single item.get.
+    """
+    def __init__(self, zapi, max_age = 600):
+        self.zapi = zapi
+        self.max_age = max_age
+
+        # host id -> (refreshed at, (Item, ...))
+        self.items_by_host = {}
+        self.lock = threading.Lock()
+
+
+    def clear(self):
+        with self.lock:
+            self.items_by_host = {}
+
+
+    def items_for_hosts(self, host_ids):
+        now = time.time()
+
+        # Take what is indexed now rather than reading it back later, the
+        # index may be cleared while we're fetching the stale hosts.
+        items_for_hosts = {}
+        stale = []
+        with self.lock:
+            for host_id in host_ids:
+                entry = self.items_by_host.get(host_id)
+                if entry is None or now - entry[0] > self.max_age:
+                    stale.append(host_id)
+                else:
+                    items_for_hosts[host_id] = entry[1]
+
+        if len(stale) > 0:
+            logging.debug('Refreshing item index for %s host(s)', len(stale))
+
+            items_zbx = self.zapi.item.get(
+                    hostids = stale,
+                    monitored = True,
+                    output = [ 'itemid', 'hostid', 'name', 'key_', 'units' ],
+            )
+
+            fresh = { host_id: [] for host_id in stale }
+            for item_zbx in items_zbx:
+                fresh[item_zbx['hostid']].append(Item(item_zbx['itemid'], item_zbx['hostid'], item_zbx['name'], item_zbx['key_'], item_zbx['units']))
+
+            with self.lock:
+                for host_id, items in fresh.items():
+                    items_for_hosts[host_id] = tuple(items)
+                    self.items_by_host[host_id] = (now, items_for_hosts[host_id])
+
+        return items_for_hosts
+
+
+    def find_items(self, host_ids, pattern):
+        items = []
+        for host_items in self.items_for_hosts(host_ids).values():
+            items.extend(item for item in host_items if pattern_matches(pattern, item.name, item.key))
+
+        return items
+
+
+    def latest_values(self, items):
+        """
+        Get the latest value of items, in one item.get.
+
+        Returns a dict item id -> (last value, last clock). Items without a
+        value yet have a last clock of 0.
+        """
+        if len(items) == 0:
+            return {}
+
+        values_zbx = self.zapi.item.get(
+                itemids = [ item.id for item in items ],
+                output = [ 'itemid', 'lastvalue', 'lastclock' ],
+        )
+
+        return { value_zbx['itemid']: (value_zbx['lastvalue'], int(value_zbx['lastclock'])) for value_zbx in values_zbx }
@@ -0,0 +1,94 @@
+import sys
+
+
+#######################################################################
+# Data model
+#
+# The Zabbix API hands us everything as dicts of strings. For a superadmin
+# that means tens of thousands of small dicts per request, so the entities
+# the bot keeps around are stored in these compact slotted classes instead.
+# All Zabbix ID's are interned, so every object referring to the same host,
+# hostgroup or graph shares a single string object.
+#######################################################################
+def intern_id(value):
+    return sys.intern(str(value))
+
+
+class TelegramUser:
+    __slots__ = ('zabbix_userid', 'zabbix_username', 'first_name', 'surname', 'is_superadmin')
+
+    def __init__(self, zabbix_userid, zabbix_username, first_name, surname, is_superadmin):
+        self.zabbix_userid = intern_id(zabbix_userid)
+        self.zabbix_username = zabbix_username
+        self.first_name = first_name
+        self.surname = surname
+        self.is_superadmin = is_superadmin
+
+    @classmethod
+    def from_zabbix(cls, zabbix_user):
+        """
+        Build a user from a user.get result with selectRole = ['type'].
+        Role type 3 is "Super admin".
+        """
+        return cls(
+                zabbix_user['userid'],
+                zabbix_user['username'],
+                zabbix_user['name'],
+                zabbix_user['surname'],
+                zabbix_user['role']['type'] == '3',
+        )
+
+    def __repr__(self):
+        return 'TelegramUser(%s, %s%s)' % (self.zabbix_userid, self.zabbix_username, ', superadmin' if self.is_superadmin else '')
+
+
+class Host:
+    __slots__ = ('id', 'name', 'graphcount')
+
+    def __init__(self, id, name, graphcount=0):
+        self.id = intern_id(id)
+        self.name = name
+        self.graphcount = graphcount
+
+    def __repr__(self):
+        return 'Host(%s, %s)' % (self.id, self.name)
+
+
+class HostGroup:
+    __slots__ = ('id', 'name', 'hosts')
+
+    def __init__(self, id, name, hosts=()):
+        self.id = intern_id(id)
+        self.name = name
+        self.hosts = tuple(hosts)
+
+    def host_ids(self):
+        return frozenset(host.id for host in self.hosts)
+
+    def __repr__(self):
+        return 'HostGroup(%s, %s, %s host(s))' % (self.id, self.name, len(self.hosts))
+
+
+class Graph:
+    __slots__ = ('id', 'name')
+
+    def __init__(self, id, name):
+        self.id = intern_id(id)
+        self.name = name
+
+    def __repr__(self):
+        return 'Graph(%s, %s)' % (self.id, self.name)
+
+
+class Item:
+    __slots__ = ('id', 'host_id', 'name', 'key', 'units')
+
+    def __init__(self, id, host_id, name, key, units=''):
+        self.id = intern_id(id)
+        self.host_id = intern_id(host_id)
+        self.name = name
+        self.key = key
+        self.units = units
+
+    def __repr__(self):
+        return 'Item(%s, %s)' % (self.id, self.key)
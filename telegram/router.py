@@ -0,0 +1,153 @@
+import logging
+import telebot, telebot.types
+
+import zabbix_frontend
+import zabbix_frontend.resilience
+from telegram.model import intern_id
+
+
+def zabbix_id(value):
+    """
+    Callback argument type for Zabbix ID's.
+    """
+    if not value.isdigit():
+        raise ValueError('Invalid Zabbix ID [%s]' % value)
+
+    return intern_id(value)
+
+
+class Router:
+    """
+    Dispatch messages and callback queries to their handlers.
+
+    Telebot checks every registered handler's filter in turn until one
+    matches. Here commands are looked up by name and callback queries by the
+    first word(s) of their data in a dict, so dispatching doesn't get slower
+    as handlers are added.
+
+    Callback data is "<prefix> <arg> <arg> ...". The arguments are split off
+    and converted with the types given at registration, and passed to the
+    handler after the callback query.
+
+    Messages and callback queries from senders not in known_senders (a dict
+    or set of Telegram user ID's as strings) are rejected before dispatching.
+    When Zabbix is unavailable or a graph is too large, the sender is told so.
+    """
+    def __init__(self, bot, known_senders):
+        self.bot = bot
+        self.known_senders = known_senders
+
+        # command name -> handler
+        self.commands = {}
+
+        # callback prefix -> (handler, argument types)
+        self.callbacks = {}
+        self.max_prefix_words = 0
+
+        self.fallback = None
+
+
+    def command(self, *names):
+        def decorator(handler):
+            for name in names:
+                self.commands[name] = handler
+            return handler
+
+        return decorator
+
+
+    def callback(self, prefix, *arg_types):
+        def decorator(handler):
+            self.callbacks[prefix] = (handler, arg_types)
+            self.max_prefix_words = max(self.max_prefix_words, len(prefix.split(' ')))
+            return handler
+
+        return decorator
+
+
+    def fallback_command(self, handler):
+        self.fallback = handler
+        return handler
+
+
+    @staticmethod
+    def normalize_command(message):
+        """
+        Lowercase the message and add a leading / if it is missing, so "Graph"
+        works as well as "/graph". Returns the command name, without any
+        @botname suffix.
+        """
+        message.text = message.text.lower()
+        if not message.text.startswith('/'):
+            logging.debug('Adding leading / to message [%s]', message.text)
+            message.text = '/' + message.text
+
+        logging.debug("+++ Final command: [%s]", message.text)
+
+        return message.text.split(None, 1)[0][1:].split('@', 1)[0]
+
+
+    def dispatch_message(self, message):
+        if str(message.from_user.id) not in self.known_senders:
+            self.bot.reply_to(message, "I don't know you. Go away")
+            return
+
+        if message.text is None:
+            return
+
+        name = self.normalize_command(message)
+        handler = self.commands.get(name, self.fallback)
+        if handler is None:
+            return
+
+        self._call(handler, message)
+
+
+    def dispatch_callback(self, cb):
+        if str(cb.from_user.id) not in self.known_senders:
+            self.bot.answer_callback_query(cb.id, "I don't know you. Go away")
+            return
+
+        words = cb.data.split(' ')
+
+        # Longest prefix first, "graph host" must not be handled as "graph"
+        for prefix_words in range(min(self.max_prefix_words, len(words)), 0, -1):
+            route = self.callbacks.get(' '.join(words[:prefix_words]))
+            if route is not None:
+                break
+        else:
+            logging.warning('No handler for callback data [%s]', cb.data)
+            self.bot.answer_callback_query(cb.id, "Sorry, I don't understand that (anymore).")
+            return
+
+        handler, arg_types = route
+        args = words[prefix_words:]
+
+        try:
+            if len(args) != len(arg_types):
+                raise ValueError('expected %s argument(s), got %s' % (len(arg_types), len(args)))
+            args = [ arg_type(arg) for arg_type, arg in zip(arg_types, args) ]
+        except ValueError as e:
+            logging.warning('Invalid callback data [%s]: %s', cb.data, e)
+            self.bot.answer_callback_query(cb.id, "Sorry, I don't understand that (anymore).")
+            return
+
+        self._call(handler, cb, *args)
+
+
+    def _call(self, handler, update, *args):
+        try:
+            handler(update, *args)
+        except zabbix_frontend.resilience.ZabbixUnavailable as e:
+            logging.warning('Zabbix unavailable in %s: %s', handler.__name__, e)
+            self._reply_error(update, "Zabbix is slow or unavailable right now. Please try again in a minute.")
+        except zabbix_frontend.GraphTooLarge as e:
+            logging.warning('Graph too large in %s: %s', handler.__name__, e)
+            self._reply_error(update, "Sorry, that graph is too large to send.")
+
+
+    def _reply_error(self, update, text):
+        if isinstance(update, telebot.types.CallbackQuery):
+            self.bot.answer_callback_query(update.id, text)
+        else:
+            self.bot.reply_to(update, text)
@@ -0,0 +1,409 @@
+import datetime
+import heapq
+import html
+import json
+import logging
+import os
+import threading
+import time
+
+import zabbix_frontend
+from telegram.model import intern_id
+
+
+#######################################################################
+# Cron schedules
+#######################################################################
+class CronSchedule:
+    """
+    A standard 5 field cron expression: minute, hour, day of month, month and
+    day of week. Each field can be *, a number, a range (1-5), a list (1,3,5)
+    and any of those with a step (*/15, 8-18/2).
+
+    As in cron, when both day of month and day of week are restricted, a day
+    matches if either of them matches.
+    """
+    FIELDS = [
+        ( 'minute', 0, 59 ),
+        ( 'hour', 0, 23 ),
+        ( 'day of month', 1, 31 ),
+        ( 'month', 1, 12 ),
+        ( 'day of week', 0, 7 ),
+    ]
+
+    def __init__(self, expression):
+        self.expression = ' '.join(expression.split())
+
+        fields = self.expression.split(' ')
+        if len(fields) != len(self.FIELDS):
+            raise ValueError('Cron expression [%s] should have %s fields' % (expression, len(self.FIELDS)))
+
+        parsed = [ self._parse_field(field, *spec) for field, spec in zip(fields, self.FIELDS) ]
+        self.minutes, self.hours, self.days, self.months, self.weekdays = parsed
+
+        # Both 0 and 7 are Sunday
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - { 7 }) | { 0 }
+
+        self.days_restricted = fields[2] != '*'
+        self.weekdays_restricted = fields[4] != '*'
+
+
+    @staticmethod
+    def _parse_field(field, name, minimum, maximum):
+        values = set()
+
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                if not step.isdigit() or int(step) == 0:
+                    raise ValueError('Invalid step in cron %s field [%s]' % (name, field))
+                step = int(step)
+
+            if part == '*':
+                first, last = minimum, maximum
+            elif '-' in part:
+                first, last = part.split('-', 1)
+                if not first.isdigit() or not last.isdigit():
+                    raise ValueError('Invalid range in cron %s field [%s]' % (name, field))
+                first, last = int(first), int(last)
+            elif part.isdigit():
+                first = last = int(part)
+                if step > 1: last = maximum     # "5/10" means "5-max/10"
+            else:
+                raise ValueError('Invalid cron %s field [%s]' % (name, field))
+
+            if first < minimum or last > maximum or first > last:
+                raise ValueError('Cron %s field [%s] out of range %s-%s' % (name, field, minimum, maximum))
+
+            values.update(range(first, last + 1, step))
+
+        return frozenset(values)
+
+
+    def _day_matches(self, dt):
+        day_match = dt.day in self.days
+        weekday_match = (dt.weekday() + 1) % 7 in self.weekdays     # Python: Monday is 0; cron: Sunday is 0
+
+        if self.days_restricted and self.weekdays_restricted:
+            return day_match or weekday_match
+
+        return day_match and weekday_match
+
+
+    def next_after(self, epoch):
+        """
+        Return the first time (as an epoch timestamp) strictly after epoch at
+        which this schedule fires, in local time.
+
+        Non-matching months, days and hours are skipped as a whole, so this
+        takes at most a few hundred iterations.
+        """
+        dt = datetime.datetime.fromtimestamp(epoch).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = dt + datetime.timedelta(days=366 * 5)
+
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+
+        raise ValueError('Cron expression [%s] never fires' % self.expression)
+
+
+    def __str__(self):
+        return self.expression
+
+
+
+#######################################################################
+# Subscriptions
+#######################################################################
+class Subscription:
+    __slots__ = ('id', 'telegram_user_id', 'chat_id', 'graph_id', 'graph_name', 'schedule', 'window', 'next_fire')
+
+    def __init__(self, id, telegram_user_id, chat_id, graph_id, graph_name, schedule, window):
+        self.id = id
+        self.telegram_user_id = intern_id(telegram_user_id)
+        self.chat_id = chat_id
+        self.graph_id = intern_id(graph_id)
+        self.graph_name = graph_name
+        self.schedule = schedule if isinstance(schedule, CronSchedule) else CronSchedule(schedule)
+        self.window = window
+        self.next_fire = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'telegram_user_id': self.telegram_user_id,
+            'chat_id': self.chat_id,
+            'graph_id': self.graph_id,
+            'graph_name': self.graph_name,
+            'schedule': str(self.schedule),
+            'window': self.window,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['telegram_user_id'], data['chat_id'], data['graph_id'],
+                data['graph_name'], data['schedule'], data['window'])
+
+    def __repr__(self):
+        return 'Subscription(%s, graph %s, [%s], %s)' % (self.id, self.graph_id, self.schedule, self.window)
+
+
+# Shortest window a subscription can have, in seconds
+MIN_WINDOW = 5 * 60
+
+
+def validate_window(window):
+    """
+    A window is a Zabbix time offset like 4h or 7d; the graph is rendered
+    from now-<window> to now. Returns the window in Zabbix notation.
+
+    Commands are lowercased before they get here, so a month (Zabbix: M)
+    can't be told apart from a minute (m). Months are written as "mo"
+    instead, and windows under MIN_WINDOW are refused, which catches a
+    month that got lowercased to minutes.
+    """
+    if window.endswith('mo'):
+        window = window[:-2] + 'M'
+
+    if zabbix_frontend.interval_between('now-' + window, 'now') < MIN_WINDOW:
+        raise ValueError('Window [%s] must be at least %s minutes. Use "mo" for months, e.g. 1mo.' % (window, MIN_WINDOW // 60))
+
+    return window
+
+
+
+class SubscriptionScheduler:
+    """
+    Sends subscribed graphs on their cron schedule.
+
+    All subscriptions are kept in one heap ordered by their next fire time and
+    handled by a single thread, however many there are. When several
+    subscriptions fire at the same time for the same graph and window, the
+    graph is rendered once: the first delivery uploads it and the others
+    reuse the Telegram file ID of that upload.
+
+    Subscriptions are persisted in a JSON file.
+
+    Before a graph is sent, graph_access(graph_id) is called once for all
+    its subscribers. It returns a function telling whether a subscriber (by
+    Telegram user ID) may still see the graph. Subscriptions for which that
+    returns false are dropped; when either raises, they are skipped this
+    time.
+    """
+
+    # Seconds between two deliveries, to stay below Telegram's limit of about
+    # 30 messages per second.
+    DELIVERY_INTERVAL = 0.05
+
+    def __init__(self, bot, filename, render_graph, graph_access = None):
+        self.bot = bot
+        self.filename = filename
+        self.render_graph = render_graph
+        self.graph_access = graph_access
+
+        self.subscriptions = {}
+        self.next_id = 1
+        self.heap = []
+
+        self.condition = threading.Condition()
+        self.thread = None
+
+
+    def start(self):
+        self.load()
+
+        self.thread = threading.Thread(target=self.run, name='subscriptions', daemon=True)
+        self.thread.start()
+
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            logging.info('No subscriptions file %s, starting without subscriptions', self.filename)
+            return
+
+        with open(self.filename) as f:
+            data = json.load(f)
+
+        with self.condition:
+            for subscription_data in data:
+                try:
+                    subscription = Subscription.from_dict(subscription_data)
+                    self._schedule(subscription, time.time())
+                except (KeyError, ValueError) as e:
+                    logging.error('Skipping invalid subscription %s: %s', subscription_data, e)
+                    continue
+
+                self.subscriptions[subscription.id] = subscription
+                self.next_id = max(self.next_id, subscription.id + 1)
+
+        logging.info('Loaded %s subscription(s) from %s', len(self.subscriptions), self.filename)
+
+
+    def save(self):
+        # Write to a temporary file first, so a crash while saving doesn't
+        # lose all subscriptions.
+        data = [ subscription.to_dict() for subscription in self.subscriptions.values() ]
+
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_filename, self.filename)
+
+
+    def add(self, telegram_user_id, chat_id, graph_id, graph_name, schedule, window):
+        with self.condition:
+            subscription = Subscription(self.next_id, telegram_user_id, chat_id, graph_id, graph_name, schedule, window)
+
+            # Raises for a schedule that never fires, before anything changed
+            self._schedule(subscription, time.time())
+
+            self.next_id += 1
+            self.subscriptions[subscription.id] = subscription
+            self.save()
+
+            # The new subscription may fire before whatever we were waiting for
+            self.condition.notify()
+
+        return subscription
+
+
+    def remove(self, subscription_id, telegram_user_id):
+        """
+        Remove a subscription, but only if it belongs to telegram_user_id.
+        Its heap entry is dropped lazily when it comes up.
+        """
+        with self.condition:
+            subscription = self.subscriptions.get(subscription_id)
+            if subscription is None or subscription.telegram_user_id != str(telegram_user_id):
+                return False
+
+            del self.subscriptions[subscription_id]
+            self.save()
+
+        return True
+
+
+    def subscriptions_for(self, telegram_user_id):
+        with self.condition:
+            return [ subscription for subscription in self.subscriptions.values()
+                    if subscription.telegram_user_id == str(telegram_user_id) ]
+
+
+    def _schedule(self, subscription, after):
+        subscription.next_fire = subscription.schedule.next_after(after)
+        heapq.heappush(self.heap, (subscription.next_fire, subscription.id))
+
+
+    def _pop_due(self):
+        """
+        Wait until at least one subscription is due and return all due
+        subscriptions, already rescheduled for their next run.
+        """
+        with self.condition:
+            while True:
+                now = time.time()
+
+                due = []
+                while len(self.heap) > 0 and self.heap[0][0] <= now:
+                    fire, subscription_id = heapq.heappop(self.heap)
+
+                    subscription = self.subscriptions.get(subscription_id)
+                    if subscription is None or subscription.next_fire != fire:
+                        continue    # Removed in the meantime
+
+                    due.append(subscription)
+                    self._schedule(subscription, now)
+
+                if len(due) > 0:
+                    return due
+
+                timeout = self.heap[0][0] - now if len(self.heap) > 0 else None
+                self.condition.wait(timeout)
+
+
+    def run(self):
+        while True:
+            due = self._pop_due()
+            logging.debug('Subscriptions due: %s', due)
+
+            # Render every distinct graph/window once
+            by_graph = {}
+            for subscription in due:
+                by_graph.setdefault((subscription.graph_id, subscription.window), []).append(subscription)
+
+            for (graph_id, window), subscriptions in by_graph.items():
+                try:
+                    self.deliver(graph_id, window, subscriptions)
+                except Exception as e:
+                    logging.error('Delivering graph %s (window %s) failed: %s', graph_id, window, e)
+
+
+    def _allowed(self, graph_id, subscriptions):
+        """
+        The subscriptions whose subscriber may still see graph_id. The ones
+        that may not are removed.
+        """
+        if self.graph_access is None:
+            return subscriptions
+
+        try:
+            may_receive = self.graph_access(graph_id)
+        except Exception as e:
+            logging.warning('Skipping %s subscription(s) to graph %s, cannot check access: %s', len(subscriptions), graph_id, e)
+            return []
+
+        allowed = []
+        for subscription in subscriptions:
+            try:
+                if may_receive(subscription.telegram_user_id):
+                    allowed.append(subscription)
+                    continue
+            except Exception as e:
+                logging.warning('Skipping subscription %s, cannot check access: %s', subscription, e)
+                continue
+
+            logging.warning('Removing subscription %s: user %s has no access to graph %s (anymore)',
+                    subscription, subscription.telegram_user_id, graph_id)
+            self.remove(subscription.id, subscription.telegram_user_id)
+
+        return allowed
+
+
+    def deliver(self, graph_id, window, subscriptions):
+        subscriptions = self._allowed(graph_id, subscriptions)
+        if len(subscriptions) == 0:
+            return
+
+        from_ts = 'now-' + window
+        to_ts = 'now'
+
+        photo = self.render_graph(graph_id, from_ts, to_ts)
+        caption = "%s from <b>%s</b> to <b>%s</b>" % (
+                html.escape(subscriptions[0].graph_name),
+                zabbix_frontend.epoch_to_absolute_time(zabbix_frontend.zabbix_time_to_epoch(from_ts)),
+                zabbix_frontend.epoch_to_absolute_time(zabbix_frontend.zabbix_time_to_epoch(to_ts)))
+
+        logging.info('Sending graph %s (window %s) to %s subscriber(s)', graph_id, window, len(subscriptions))
+
+        for subscription in subscriptions:
+            try:
+                message = self.bot.send_photo(subscription.chat_id, photo=photo, caption=caption)
+
+                # Reuse the uploaded image for the other subscribers
+                if not isinstance(photo, str):
+                    photo = message.photo[-1].file_id
+            except Exception as e:
+                logging.error('Sending subscription %s failed: %s', subscription, e)
+
+            time.sleep(self.DELIVERY_INTERVAL)
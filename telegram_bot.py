@@ -29,11 +29,17 @@ import sys, configparser, telebot
 import getopt
 import logging
 import os.path
+import signal
+import threading
 
 from pyzabbix import ZabbixAPI
 
 import telegram.commands
+import telegram.model
 import zabbix_frontend
+import zabbix_frontend.resilience
+import zabbix_frontend.warming
+from zabbix_frontend.cache import LRUCache
 
 
 def usage():
@@ -83,46 +89,57 @@ def parse_commandline(argv = sys.argv[1:]):
     return cmdline_config
 
 
-def main():
-    logging.basicConfig(format='%(message)s')
-
-    cmdline_config = parse_commandline()
-    logging.debug("Config: %s", cmdline_config)
-
+# (command line option, (config file section, config file option), name)
+CONFIG_OPTIONS = [
+    ( 'telegram-id', ('Telegram Settings', 'API-Token'), 'telegram-API-token' ),
+    ( None, ('Zabbix Settings', 'Server'), 'zabbix-server' ),
+    ( None, ('Zabbix Settings', 'Token'), 'zabbix-token' ),
+    ( None, ('Zabbix Settings', 'Username'), 'zabbix-username' ),
+    ( None, ('Zabbix Settings', 'Password'), 'zabbix-password' ),
+    ( None, ('Zabbix Settings', 'TelegramMediaType'), 'zabbix-telegram-mediatype'),
+    ( None, ('Zabbix Settings', 'Timeout'), 'zabbix-timeout'),
+    ( None, ('Zabbix Settings', 'FrontendTimeout'), 'zabbix-frontend-timeout'),
+    ( None, ('Zabbix Settings', 'FallbackFrontend'), 'zabbix-fallback-frontend'),
+    ( None, ('Zabbix Settings', 'HedgeDelay'), 'zabbix-hedge-delay'),
+    ( None, ('Zabbix Settings', 'StreamGraphs'), 'zabbix-stream-graphs'),
+    ( None, ('Zabbix Settings', 'MaxGraphSize'), 'zabbix-max-graph-size'),
+    ( None, ('Zabbix Settings', 'GraphFetchConcurrency'), 'zabbix-graph-fetch-concurrency'),
+    ( None, ('Subscription Settings', 'File'), 'subscriptions-file'),
+    ( None, ('Graph Cache Settings', 'Entries'), 'graph-cache-entries'),
+    ( None, ('Graph Cache Settings', 'FreshAge'), 'graph-cache-fresh-age'),
+    ( None, ('Graph Cache Settings', 'WarmTopK'), 'graph-warm-top-k'),
+    ( None, ('Graph Cache Settings', 'WarmInterval'), 'graph-warm-interval'),
+    ( None, ('Graph Cache Settings', 'WarmBudget'), 'graph-warm-budget'),
+]
+
+# Which components use which config options, for reloading
+ZABBIX_API_OPTIONS = ( 'zabbix-server', 'zabbix-token', 'zabbix-username', 'zabbix-password', 'zabbix-timeout' )
+ZABBIX_FRONTEND_OPTIONS = ( 'zabbix-server', 'zabbix-username', 'zabbix-password', 'zabbix-fallback-frontend',
+        'zabbix-frontend-timeout', 'zabbix-hedge-delay', 'zabbix-stream-graphs', 'zabbix-max-graph-size',
+        'graph-cache-entries', 'graph-cache-fresh-age' )
+TELEGRAM_USERS_OPTIONS = ZABBIX_API_OPTIONS + ( 'zabbix-telegram-mediatype', )
+GRAPH_WARMER_OPTIONS = ( 'graph-warm-top-k', 'graph-warm-interval', 'graph-warm-budget' )
+RESTART_OPTIONS = ( 'telegram-API-token', 'subscriptions-file', 'zabbix-graph-fetch-concurrency' )
+
+
+def read_config(cmdline_config):
     configfile_parser = configparser.ConfigParser()
-    # Open settings.ini file to retrieve API token
-    try:
-            with open(cmdline_config['config-file']) as f:
-                    configfile_parser.read_file(f)
-    except:
-            e = sys.exc_info()[1]
-            print(e)
-            sys.exit(1)
+    with open(cmdline_config['config-file']) as f:
+        configfile_parser.read_file(f)
 
     # Put configuration in the actual config dictionary. Use the value specified
     # on the command line if it has a value, fall back to the config file if it
     # does not.
     config = {}
-    for cmdline_option, configfile_option, name in [
-        ( 'telegram-id', ('Telegram Settings', 'API-Token'), 'telegram-API-token' ),
-        ( None, ('Zabbix Settings', 'Server'), 'zabbix-server' ),
-        ( None, ('Zabbix Settings', 'Token'), 'zabbix-token' ),
-        ( None, ('Zabbix Settings', 'Username'), 'zabbix-username' ),
-        ( None, ('Zabbix Settings', 'Password'), 'zabbix-password' ),
-        ( None, ('Zabbix Settings', 'TelegramMediaType'), 'zabbix-telegram-mediatype'),
-    ]:
+    for cmdline_option, configfile_option, name in CONFIG_OPTIONS:
         logging.debug("Parsing config option %(name)s" % {'name': name})
         config[name] = cmdline_config[cmdline_option] if cmdline_config.get(cmdline_option) else configfile_parser.get(configfile_option[0], configfile_option[1], fallback=None)
 
-    telegram_token = config['telegram-API-token']
+    return config
 
-    if telegram_token == '':
-        log = logging.getLogger(__name__)
-        log.error('No Telegram API token specified. Configure it in the config file or specify it on the command line')
-        sys.exit(1)
 
-    # Initialize Zabbix API connector
-    zapi = ZabbixAPI(config['zabbix-server'])
+def connect_zabbix_api(config):
+    zapi = ZabbixAPI(config['zabbix-server'], timeout = float(config['zabbix-timeout'] or 10))
 
     if config.get('zabbix-token'):
         logging.debug('Using API token to log in to the Zabbix API')
@@ -133,9 +150,22 @@ def main():
 
     logging.info('Connected to Zabbix API version %s, host: %s', zapi.api_version(), config['zabbix-server'])
 
-    zabbix_frontend.init(config['zabbix-server'], config['zabbix-username'], config['zabbix-password'])
+    return zapi
+
+
+def init_zabbix_frontend(config):
+    zabbix_frontend.init(config['zabbix-server'], config['zabbix-username'], config['zabbix-password'],
+            fallback_server = config['zabbix-fallback-frontend'],
+            timeout = float(config['zabbix-frontend-timeout'] or 20),
+            hedge_delay = float(config['zabbix-hedge-delay'] or 2),
+            stream_graphs = (config['zabbix-stream-graphs'] or 'no').lower() in ('yes', 'true', 'on', '1'),
+            max_graph_size = int(config['zabbix-max-graph-size'] or 10 * 1024 * 1024),
+            graph_cache_entries = int(config['graph-cache-entries'] or 128),
+            graph_fresh_age = float(config['graph-cache-fresh-age'] or 60),
+            fetch_concurrency = int(config['zabbix-graph-fetch-concurrency'] or 0) or telegram.commands.CommandHandler.GRAPH_FETCH_CONCURRENCY)
 
 
+def get_telegram_users(zapi, config):
     # Get Zabbix users who have Telegram media configured, with their "sendto"
     # values.
     # The "sendto" values are assumed to be Telegram user ID's, which are used
@@ -163,13 +193,7 @@ def main():
 
     telegram_users = {}
     for zabbix_user in zabbix_users_with_telegram:
-        user = {
-            'zabbix_userid': zabbix_user['userid'],
-            'zabbix_username': zabbix_user['username'],
-            'first_name': zabbix_user['name'],
-            'surname': zabbix_user['surname'],
-            'is_superadmin': zabbix_user['role']['type'] == '3'
-        }
+        user = telegram.model.TelegramUser.from_zabbix(zabbix_user)
 
         # Filter all medias for user, so we only keep the entry with the Telegram
         # mediatype.
@@ -179,8 +203,168 @@ def main():
 
     logging.debug('Telegram users I know about now: %s', telegram_users)
 
+    return telegram_users
+
+
+def create_graph_warmer(config):
+    if int(config['graph-warm-top-k'] or 0) <= 0:
+        return None
+
+    graph_warmer = zabbix_frontend.warming.GraphWarmer(
+            top_k = int(config['graph-warm-top-k']),
+            interval = float(config['graph-warm-interval'] or 45),
+            budget = float(config['graph-warm-budget'] or 0.1))
+    graph_warmer.start()
+
+    return graph_warmer
+
+
+class ConfigReloader:
+    """
+    Re-read the config file while the bot keeps running, and re-initialise
+    only the components whose settings changed. Caches, subscriptions and
+    the Telegram polling loop are left alone.
+
+    Changing the Telegram API token or the subscriptions file still needs a
+    restart.
+    """
+    def __init__(self, cmdline_config, config, bot_handler):
+        self.cmdline_config = cmdline_config
+        self.config = config
+        self.bot_handler = bot_handler
+        self.lock = threading.Lock()
+
+
+    def reload(self):
+        """
+        Returns a list of lines describing what was reloaded.
+        """
+        with self.lock:
+            try:
+                return self._reload()
+            except Exception as e:
+                logging.error('Reloading the configuration failed: %s', e)
+                return [ 'Reloading the configuration failed: %s' % e ]
+
+
+    def _reload(self):
+        logging.info('Reloading configuration from %s', self.cmdline_config['config-file'])
+
+        new_config = read_config(self.cmdline_config)
+        changed = { name for name in new_config if new_config[name] != self.config.get(name) }
+        logging.debug('Changed config options: %s', changed)
+
+        if len(changed) == 0:
+            return [ 'Configuration unchanged.' ]
+
+        report = []
+
+        # Keep using, and remembering, the values actually in use for options
+        # that need a restart
+        needs_restart = sorted(changed & set(RESTART_OPTIONS))
+        for name in needs_restart:
+            new_config[name] = self.config[name]
+
+        if changed & set(ZABBIX_API_OPTIONS):
+            # If the new settings don't work, this raises and we keep using
+            # the old connection.
+            zapi = connect_zabbix_api(new_config)
+
+            # Another server, or another user who may see other things:
+            # nothing we have cached is valid anymore
+            server_changed = 'zabbix-server' in changed
+            identity_changed = server_changed or bool(changed & { 'zabbix-username', 'zabbix-token' })
+
+            self.bot_handler.zapi.set_client(zapi, clear_cache = identity_changed)
+            if identity_changed:
+                self.bot_handler.hostgroups_cache = LRUCache(self.bot_handler.hostgroups_cache.max_entries)
+            if server_changed:
+                self.bot_handler.item_index.clear()
+                if self.bot_handler.graph_warmer is not None:
+                    self.bot_handler.graph_warmer.reset()
+            report.append('Reconnected to the Zabbix API.')
+
+        if changed & set(TELEGRAM_USERS_OPTIONS):
+            # Update in place, the router and handlers share this dict
+            telegram_users = get_telegram_users(self.bot_handler.zapi, new_config)
+            for telegram_id in list(self.bot_handler.telegram_users):
+                if telegram_id not in telegram_users:
+                    del self.bot_handler.telegram_users[telegram_id]
+            self.bot_handler.telegram_users.update(telegram_users)
+            report.append('Reloaded Telegram users: %s known.' % len(telegram_users))
+
+        if changed & set(ZABBIX_FRONTEND_OPTIONS):
+            init_zabbix_frontend(new_config)
+            report.append('Reconfigured the Zabbix frontend.')
+
+        if changed & set(GRAPH_WARMER_OPTIONS):
+            graph_warmer = self.bot_handler.graph_warmer
+            if graph_warmer is None:
+                self.bot_handler.graph_warmer = create_graph_warmer(new_config)
+            else:
+                # Setting top_k to 0 leaves the thread idling
+                graph_warmer.top_k = int(new_config['graph-warm-top-k'] or 0)
+                graph_warmer.interval = float(new_config['graph-warm-interval'] or 45)
+                graph_warmer.budget = float(new_config['graph-warm-budget'] or 0.1)
+            report.append('Reconfigured graph warming.')
+
+        if len(needs_restart) > 0:
+            report.append('Changes to %s need a restart.' % ', '.join(needs_restart))
+
+        self.config = new_config
+
+        for line in report:
+            logging.info(line)
+
+        return report
+
+
+def main():
+    logging.basicConfig(format='%(message)s')
+
+    cmdline_config = parse_commandline()
+    logging.debug("Config: %s", cmdline_config)
+
+    # Open settings.ini file to retrieve API token
+    try:
+            config = read_config(cmdline_config)
+    except:
+            e = sys.exc_info()[1]
+            print(e)
+            sys.exit(1)
+
+    telegram_token = config['telegram-API-token']
+
+    if telegram_token == '':
+        log = logging.getLogger(__name__)
+        log.error('No Telegram API token specified. Configure it in the config file or specify it on the command line')
+        sys.exit(1)
+
+    # Initialize Zabbix API connector
+    zapi = connect_zabbix_api(config)
+
+    init_zabbix_frontend(config)
+
+    telegram_users = get_telegram_users(zapi, config)
+
+
+    # From here on, all API calls go through a circuit breaker
+    zapi = zabbix_frontend.resilience.ResilientZabbixAPI(zapi)
+
+    graph_warmer = create_graph_warmer(config)
+
+    bot_handler = telegram.commands.CommandHandler(telegram_token, zapi, telegram_users,
+            subscriptions_file = config['subscriptions-file'] or 'subscriptions.json',
+            graph_warmer = graph_warmer,
+            graph_fetch_concurrency = int(config['zabbix-graph-fetch-concurrency'] or 0) or None)
+
+
+    # Reload the configuration on SIGHUP or /reload. The signal handler
+    # starts a thread, so the reload doesn't run inside the signal handler.
+    reloader = ConfigReloader(cmdline_config, config, bot_handler)
+    bot_handler.reload_config = reloader.reload
 
-    bot_handler = telegram.commands.CommandHandler(telegram_token, zapi, telegram_users)
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reloader.reload, name='reload-config').start())
 
 
     # Start the bot
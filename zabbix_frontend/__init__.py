@@ -1,28 +1,108 @@
+import concurrent.futures
+import io
 import logging
 import sys
 import requests
 import re
+import tempfile
+import threading
 import time
 
+from zabbix_frontend.cache import LRUCache
+from zabbix_frontend.resilience import CircuitBreaker, ZabbixUnavailable
+
 this = sys.modules[__name__]
 this.zabbix_server = None
 this.zabbix_username = None
 this.zabbix_password = None
-this.session_token = None
+
+# Optional second frontend for the same Zabbix server. Graph fetches that
+# take longer than hedge_delay seconds are sent there as well.
+this.fallback_server = None
+this.hedge_delay = 2
+
+# Request timeout in seconds
+this.timeout = 20
+
+# Session token per frontend server
+this.session_tokens = {}
+
+# Graphs can be fetched from several threads at once (e.g. for dashboards),
+# make sure only one of them logs in.
+this.login_lock = threading.Lock()
+
+this.graph_breaker = CircuitBreaker('zabbix-frontend')
+
+# With a fallback frontend, fetches from the primary and the fallback run on
+# separate pools, so hedges never queue behind the slow primary fetches they
+# are racing. Each pool has room for twice the number of graphs fetched at
+# the same time (dashboards plus everything else).
+this.fetch_concurrency = 10
+this.primary_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2 * this.fetch_concurrency, thread_name_prefix='graph-primary')
+this.hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2 * this.fetch_concurrency, thread_name_prefix='graph-hedge')
+
+# Last rendered version of recently requested graphs. Entries younger than
+# graph_fresh_age seconds are served instead of rendering the graph again;
+# older ones only when the frontend is unavailable.
+this.graph_cache = LRUCache(128)
+this.graph_fresh_age = 60
+
+# In streaming mode get_graph returns a file object instead of bytes. The
+# image is read from the frontend in chunks into a temporary file that only
+# goes to disk once it is larger than spool_size.
+this.stream_graphs = False
+this.spool_size = 1024 * 1024
+
+# Larger graphs are refused, streaming or not
+this.max_graph_size = 10 * 1024 * 1024
 
 
-def init(server, username, password):
+class GraphTooLarge(ValueError):
+    pass
+
+
+def init(server, username, password, fallback_server = None, timeout = 20, hedge_delay = 2, graph_cache_entries = 128, graph_fresh_age = 60, stream_graphs = False, max_graph_size = 10 * 1024 * 1024,
+        fetch_concurrency = 10):
+    # init() is also called when the configuration is reloaded. Keep the
+    # sessions and cached graphs unless they belong to another server or user.
+    if (server, username, password) != (this.zabbix_server, this.zabbix_username, this.zabbix_password):
+        this.session_tokens = {}
+
+    if server != this.zabbix_server:
+        this.graph_cache = LRUCache(graph_cache_entries)
+        this.graph_breaker.reset()
+    else:
+        this.graph_cache.resize(graph_cache_entries)
+
     this.zabbix_server = server
     this.zabbix_username = username
     this.zabbix_password = password
+    this.fallback_server = fallback_server or None
+    this.timeout = timeout
+    this.hedge_delay = hedge_delay
+    this.graph_fresh_age = graph_fresh_age
+    this.stream_graphs = stream_graphs
+    this.max_graph_size = max_graph_size
+
+    if fetch_concurrency != this.fetch_concurrency:
+        # Running fetches finish on the old pools
+        old_pools = ( this.primary_pool, this.hedge_pool )
+        this.fetch_concurrency = fetch_concurrency
+        this.primary_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2 * fetch_concurrency, thread_name_prefix='graph-primary')
+        this.hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2 * fetch_concurrency, thread_name_prefix='graph-hedge')
+        for pool in old_pools:
+            pool.shutdown(wait=False)
+
+    logging.debug("Initializing Zabbix frontend module with server: %s, fallback server: %s, username: %s", this.zabbix_server, this.fallback_server, this.zabbix_username)
 
-    logging.debug("Initializing Zabbix frontend module with server: %s, username: %s", this.zabbix_server, this.zabbix_username)
 
+def do_login(server = None):
+    if server is None:
+        server = this.zabbix_server
 
-def do_login():
-    logging.debug("Logging in to Zabbix frontend")
+    logging.debug("Logging in to Zabbix frontend %s", server)
 
-    url = this.zabbix_server + '/index.php'
+    url = server + '/index.php'
 
     post_fields = {
             'name': this.zabbix_username,
@@ -32,17 +112,31 @@ def do_login():
             'enter': 'Sign in',
     }
 
-    r = requests.post(url, data=post_fields)
+    r = requests.post(url, data=post_fields, timeout=this.timeout)
 
-    this.session_token = r.cookies['zbx_session']
+    this.session_tokens[server] = r.cookies['zbx_session']
 
-    pass
 
-def get_graph(graph_id, from_ts, to_ts, width, height):
-    if this.session_token is None:
-        do_login()
+def get_graph(graph_id, from_ts, to_ts, width, height, stream = None, refresh = False):
+    """
+    Render a graph on the Zabbix frontend and return the PNG image, as bytes
+    or, if stream is true, as a file object. stream defaults to the
+    stream_graphs setting.
+
+    A cached image younger than graph_fresh_age seconds is returned as is,
+    unless refresh is true.
+
+    Fetches go through a circuit breaker. When the frontend fails or the
+    breaker is open, the last image of the same graph and period is returned
+    if we have one; otherwise ZabbixUnavailable is raised. Streamed graphs
+    only end up in that cache if they are small enough to have stayed in
+    memory (spool_size).
+
+    Graphs larger than max_graph_size raise GraphTooLarge.
+    """
+    if stream is None:
+        stream = this.stream_graphs
 
-    url = this.zabbix_server + '/chart2.php'
     params = {
             'graphid': graph_id,
             'from': from_ts,
@@ -51,13 +145,118 @@ def get_graph(graph_id, from_ts, to_ts, width, height):
             'height': height,
             'profileIdx': 'web.charts.filter',
     }
-    cookies = { 'zbx_session': this.session_token }
+    cache_key = (str(graph_id), from_ts, to_ts, width, height)
+
+    if not refresh and this.graph_fresh_age > 0:
+        cached = this.graph_cache.get(cache_key, max_age=this.graph_fresh_age)
+        if cached is not None:
+            logging.debug('Serving graph %s from cache', graph_id)
+            return io.BytesIO(cached[1]) if stream else cached[1]
+
+    try:
+        graph = this.graph_breaker.call(_fetch_graph_hedged, params, stream, ignore = (GraphTooLarge,))
+    except ZabbixUnavailable as e:
+        cached = this.graph_cache.get(cache_key)
+        if cached is None:
+            raise
+
+        logging.warning('%s; serving cached graph %s from %s', e, graph_id, time.ctime(cached[0]))
+        return io.BytesIO(cached[1]) if stream else cached[1]
+
+    if not stream:
+        this.graph_cache.put(cache_key, graph)
+    elif not getattr(graph, '_rolled', True):
+        # Not spooled to disk, so we have the bytes in memory anyway
+        this.graph_cache.put(cache_key, graph.read())
+        graph.seek(0)
+
+    return graph
+
 
-    r = requests.get(url, params=params, cookies=cookies)
+def _fetch_graph(server, params, stream):
+    if server not in this.session_tokens:
+        with this.login_lock:
+            if server not in this.session_tokens:
+                do_login(server)
 
-    logging.debug('Retrieved graph, headers are: %s', r.headers)
+    url = server + '/chart2.php'
+    cookies = { 'zbx_session': this.session_tokens[server] }
 
-    return r.content
+    with requests.get(url, params=params, cookies=cookies, timeout=this.timeout, stream=True) as r:
+        logging.debug('Retrieved graph, headers are: %s', r.headers)
+
+        r.raise_for_status()
+        if not r.headers.get('Content-Type', '').startswith('image/'):
+            # Most likely our session expired and we got the login page. Log in
+            # again next time.
+            this.session_tokens.pop(server, None)
+            raise ValueError('Got %s instead of a graph from %s' % (r.headers.get('Content-Type'), server))
+
+        if int(r.headers.get('Content-Length', 0)) > this.max_graph_size:
+            raise GraphTooLarge('Graph from %s is %s bytes, more than the maximum of %s' % (server, r.headers['Content-Length'], this.max_graph_size))
+
+        graph = tempfile.SpooledTemporaryFile(max_size=this.spool_size) if stream else io.BytesIO()
+        size = 0
+        for chunk in r.iter_content(chunk_size=64 * 1024):
+            size += len(chunk)
+            if size > this.max_graph_size:
+                graph.close()
+                raise GraphTooLarge('Graph from %s is more than the maximum of %s bytes' % (server, this.max_graph_size))
+
+            graph.write(chunk)
+
+    if not stream:
+        return graph.getvalue()
+
+    graph.seek(0)
+    return graph
+
+
+def _fetch_graph_hedged(params, stream):
+    """
+    Fetch a graph from the primary frontend. If it fails, or hasn't answered
+    within hedge_delay seconds, ask the fallback frontend as well and use
+    whichever answers first.
+    """
+    if this.fallback_server is None:
+        return _fetch_graph(this.zabbix_server, params, stream)
+
+    primary = this.primary_pool.submit(_fetch_graph, this.zabbix_server, params, stream)
+    try:
+        return primary.result(timeout=this.hedge_delay)
+    except concurrent.futures.TimeoutError:
+        logging.debug('Primary frontend slow, also asking %s', this.fallback_server)
+    except GraphTooLarge:
+        raise
+    except Exception as e:
+        logging.warning('Primary frontend failed (%s), trying %s', e, this.fallback_server)
+        return _fetch_graph(this.fallback_server, params, stream)
+
+    hedge = this.hedge_pool.submit(_fetch_graph, this.fallback_server, params, stream)
+
+    pending = { primary, hedge }
+    error = None
+    while len(pending) > 0:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+
+            # Close the other graph's temporary file whenever it arrives
+            if stream:
+                for loser in ( primary, hedge ):
+                    if loser is not future:
+                        loser.add_done_callback(_close_graph)
+
+            return future.result()
+
+    raise error
+
+
+def _close_graph(future):
+    if future.exception() is None:
+        future.result().close()
 
 
 def interval_between(from_ts, to_ts):
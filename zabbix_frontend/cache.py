@@ -0,0 +1,51 @@
+import collections
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Thread-safe cache keeping the max_entries most recently used entries.
+
+    Entries are stored with the time they were put in the cache, so callers
+    can decide for themselves whether an entry is fresh enough: a stale entry
+    is still better than nothing when Zabbix is down.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, max_age = None):
+        """
+        Return (stored_at, value) for key, or None if there is no entry or
+        it is older than max_age seconds.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            if max_age is not None and time.time() - entry[0] > max_age:
+                return None
+
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def resize(self, max_entries):
+        with self.lock:
+            self.max_entries = max_entries
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,252 @@
+import json
+import logging
+import threading
+import time
+
+from pyzabbix import ZabbixAPIException
+
+from zabbix_frontend.cache import LRUCache
+
+
+class ZabbixUnavailable(Exception):
+    """
+    Zabbix didn't answer in time (or at all) and there is no cached answer
+    to fall back on.
+    """
+    pass
+
+
+#######################################################################
+# Circuit breaker
+#######################################################################
+class CircuitBreaker:
+    """
+    Stop calling an endpoint that keeps failing.
+
+    After failure_threshold consecutive failures the breaker opens and every
+    call fails immediately with ZabbixUnavailable. After reset_timeout
+    seconds one trial call is let through ("half open"): if it succeeds the
+    breaker closes again, if it fails the breaker stays open for another
+    reset_timeout.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold = 5, reset_timeout = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+        self.counters = {
+            'calls': 0,
+            'failures': 0,
+            'rejected': 0,
+            'opened': 0,
+        }
+
+        breakers[name] = self
+
+
+    def _set_state(self, state):
+        if state != self.state:
+            logging.warning('Circuit breaker %s: %s -> %s', self.name, self.state, state)
+            self.state = state
+
+
+    def _before_call(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    self.counters['rejected'] += 1
+                    raise ZabbixUnavailable('Circuit breaker %s is open' % self.name)
+
+                self._set_state(self.HALF_OPEN)
+            elif self.state == self.HALF_OPEN:
+                # Only one trial call at a time
+                self.counters['rejected'] += 1
+                raise ZabbixUnavailable('Circuit breaker %s is half open' % self.name)
+
+            self.counters['calls'] += 1
+
+
+    def _on_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self._set_state(self.CLOSED)
+
+
+    def _on_failure(self):
+        with self.lock:
+            self.counters['failures'] += 1
+            self.consecutive_failures += 1
+
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.counters['opened'] += 1
+                self._set_state(self.OPEN)
+                self.opened_at = time.time()
+
+
+    def call(self, func, *args, ignore = (), **kwargs):
+        """
+        Call func through the breaker. Any exception counts as a failure and
+        is re-raised as ZabbixUnavailable, except for the exception types in
+        ignore: those mean the endpoint did answer, and are passed through.
+        """
+        self._before_call()
+
+        try:
+            result = func(*args, **kwargs)
+        except ignore:
+            self._on_success()
+            raise
+        except Exception as e:
+            self._on_failure()
+            raise ZabbixUnavailable('%s failed: %s' % (self.name, e)) from e
+
+        self._on_success()
+        return result
+
+
+    def reset(self):
+        """
+        Close the breaker and forget past failures, e.g. when the endpoint
+        has been replaced by another one.
+        """
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._set_state(self.CLOSED)
+
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['state'] = self.state
+            stats['consecutive_failures'] = self.consecutive_failures
+            return stats
+
+
+# All breakers by name, for stats()
+breakers = {}
+
+
+def stats():
+    """
+    State and counters of all circuit breakers, by breaker name.
+    """
+    return { name: breaker.stats() for name, breaker in breakers.items() }
+
+
+
+#######################################################################
+# Zabbix API
+#######################################################################
+def api_error_code(e):
+    """
+    The error code of a ZabbixAPIException raised for an error reported by
+    Zabbix itself, or None when pyzabbix raised it because the reply wasn't
+    a proper API reply (e.g. "Received empty response" or "Unable to parse
+    json"). Newer pyzabbix versions pass the error object as e.error, older
+    ones only the code as second argument.
+    """
+    error = getattr(e, 'error', None)
+    if isinstance(error, dict) and 'code' in error:
+        return error['code']
+
+    if len(e.args) > 1 and isinstance(e.args[1], int):
+        return e.args[1]
+
+    return None
+
+
+class _APIError(Exception):
+    """
+    Carries an API error through the circuit breaker; see ResilientZabbixAPI.
+    """
+    pass
+
+
+class ResilientZabbixAPI:
+    """
+    Wrapper around a (logged in) pyzabbix ZabbixAPI that sends every call
+    through a circuit breaker.
+
+    Successful results of the methods in cached_methods are cached; when such
+    a call fails or the breaker is open, the last result for the same call is
+    returned instead, however old. Only when there is none, ZabbixUnavailable
+    is raised. Other methods (item.get, with ever changing values and up to
+    all items of all hosts) are not cached.
+
+    Errors reported by Zabbix itself (ZabbixAPIException with an error code,
+    e.g. invalid parameters) mean Zabbix is up and are passed through
+    untouched. Empty or garbled replies count as failures.
+
+    Use it like the ZabbixAPI object: zapi.host.get(...).
+    """
+    CACHED_METHODS = ( 'user.get', 'usergroup.get', 'hostgroup.get', 'host.get', 'graph.get', 'dashboard.get' )
+
+    def __init__(self, zapi, cache_entries = 256, failure_threshold = 5, reset_timeout = 30, cached_methods = CACHED_METHODS):
+        self.zapi = zapi
+        self.breaker = CircuitBreaker('zabbix-api', failure_threshold, reset_timeout)
+        self.cache = LRUCache(cache_entries)
+        self.cached_methods = frozenset(cached_methods)
+
+    def __getattr__(self, name):
+        return _ResilientAPIObject(self, name)
+
+    def set_client(self, zapi, clear_cache = False):
+        """
+        Switch to another ZabbixAPI object, e.g. after the configuration has
+        been reloaded. Cached results are kept unless clear_cache is true;
+        then the circuit breaker is reset as well, as its failures were
+        those of another server or user.
+        """
+        self.zapi = zapi
+        if clear_cache:
+            self.cache = LRUCache(self.cache.max_entries)
+            self.breaker.reset()
+
+    def _call_api(self, api_object, api_method, params):
+        try:
+            return getattr(getattr(self.zapi, api_object), api_method)(**params)
+        except ZabbixAPIException as e:
+            if api_error_code(e) is None:
+                raise
+            raise _APIError() from e
+
+    def call(self, method, params):
+        api_object, api_method = method.split('.')
+        cached_method = method in self.cached_methods
+        cache_key = (method, json.dumps(params, sort_keys=True, default=str)) if cached_method else None
+
+        try:
+            result = self.breaker.call(self._call_api, api_object, api_method, params, ignore = (_APIError,))
+        except _APIError as e:
+            raise e.__cause__ from None
+        except ZabbixUnavailable as e:
+            cached = self.cache.get(cache_key) if cached_method else None
+            if cached is None:
+                raise
+
+            logging.warning('%s; serving cached %s result from %s', e, method, time.ctime(cached[0]))
+            return cached[1]
+
+        if cached_method:
+            self.cache.put(cache_key, result)
+        return result
+
+
+class _ResilientAPIObject:
+    def __init__(self, api, name):
+        self.api = api
+        self.name = name
+
+    def __getattr__(self, method):
+        return lambda **params: self.api.call(self.name + '.' + method, params)
@@ -0,0 +1,203 @@
+import heapq
+import logging
+import math
+import threading
+import time
+
+import zabbix_frontend
+from zabbix_frontend.resilience import CircuitBreaker
+
+
+class PopularityTracker:
+    """
+    Exponentially decaying view counter per key.
+
+    Every view adds 1 to the key's score, and scores halve every half_life
+    seconds, so a graph that was popular yesterday but isn't looked at today
+    quickly drops out of the top.
+    """
+    def __init__(self, half_life = 3600):
+        self.decay_rate = math.log(2) / half_life
+
+        # key -> (score, time of last update)
+        self.scores = {}
+        self.lock = threading.Lock()
+
+
+    def _decayed(self, score, updated_at, now):
+        return score * math.exp(-self.decay_rate * (now - updated_at))
+
+
+    def record(self, key):
+        now = time.time()
+        with self.lock:
+            score, updated_at = self.scores.get(key, (0, now))
+            self.scores[key] = (self._decayed(score, updated_at, now) + 1, now)
+
+
+    def top(self, count, min_score = 0):
+        """
+        The count keys with the highest score, highest first, leaving out
+        keys scoring below min_score. Keys whose score has decayed to nearly
+        nothing are forgotten.
+        """
+        now = time.time()
+        with self.lock:
+            scores = { key: self._decayed(score, updated_at, now) for key, (score, updated_at) in self.scores.items() }
+
+            for key, score in scores.items():
+                if score < 0.01:
+                    del self.scores[key]
+
+        top = heapq.nlargest(count, scores.items(), key=lambda item: item[1])
+        return [ key for key, score in top if score >= min_score ]
+
+
+
+class GraphWarmer:
+    """
+    Keep the most viewed graphs rendered in the frontend graph cache.
+
+    Views of the default graph window are counted with a PopularityTracker.
+    Every interval seconds the top_k graphs are rendered again, so viewers
+    get them from the cache instead of waiting for chart2.php. Rendering is
+    sequential, and a cycle stops once it has spent more than budget (a
+    fraction of interval) rendering. Nothing is rendered while the frontend
+    circuit breaker isn't closed.
+
+    For this to work, the graph cache must serve entries that are at least
+    interval seconds old (zabbix_frontend graph_fresh_age).
+    """
+    def __init__(self, top_k = 10, interval = 45, budget = 0.1, min_score = 1,
+            from_ts = 'now-4h', to_ts = 'now', width = 1200, height = 400):
+        self.top_k = top_k
+        self.interval = interval
+        self.budget = budget
+        self.min_score = min_score
+
+        # The window and size used by the /graph callbacks
+        self.from_ts = from_ts
+        self.to_ts = to_ts
+        self.width = width
+        self.height = height
+
+        self.popularity = PopularityTracker()
+
+        # graph id -> time we put it in the cache
+        self.warmed_at = {}
+
+        self.lock = threading.Lock()
+        self.counters = {
+            'views': 0,
+            'warm_hits': 0,
+            'renders': 0,
+            'render_failures': 0,
+            'over_budget': 0,
+        }
+
+        self.thread = None
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='graph-warmer', daemon=True)
+        self.thread.start()
+
+
+    def reset(self):
+        """
+        Forget which graphs are popular, e.g. when they are graphs of another
+        Zabbix server now.
+        """
+        with self.lock:
+            self.popularity = PopularityTracker()
+            self.warmed_at = {}
+
+
+    def _cache_key(self, graph_id):
+        return (str(graph_id), self.from_ts, self.to_ts, self.width, self.height)
+
+
+    def record_view(self, graph_id, from_ts, to_ts, width, height):
+        """
+        Count a view of a graph. Call this before fetching the graph, so we
+        can tell whether the view is served by a graph we warmed.
+        """
+        if (from_ts, to_ts, width, height) != (self.from_ts, self.to_ts, self.width, self.height):
+            return
+
+        graph_id = str(graph_id)
+        self.popularity.record(graph_id)
+
+        cached = zabbix_frontend.graph_cache.get(self._cache_key(graph_id), max_age=zabbix_frontend.graph_fresh_age)
+
+        with self.lock:
+            self.counters['views'] += 1
+            if cached is not None and cached[0] == self.warmed_at.get(graph_id):
+                self.counters['warm_hits'] += 1
+
+
+    def warm(self):
+        started = time.time()
+        max_render_time = self.budget * self.interval
+
+        top = self.popularity.top(self.top_k, self.min_score)
+
+        with self.lock:
+            self.warmed_at = { graph_id: warmed_at for graph_id, warmed_at in self.warmed_at.items() if graph_id in top }
+
+        for graph_id in top:
+            if zabbix_frontend.graph_breaker.state != CircuitBreaker.CLOSED:
+                logging.debug('Frontend circuit breaker not closed, not warming graphs')
+                return
+
+            if time.time() - started > max_render_time:
+                with self.lock:
+                    self.counters['over_budget'] += 1
+                logging.debug('Graph warming budget of %.1fs used up', max_render_time)
+                return
+
+            # Someone else rendered it recently enough
+            before = zabbix_frontend.graph_cache.get(self._cache_key(graph_id))
+            if before is not None and time.time() - before[0] <= self.interval / 2:
+                continue
+
+            try:
+                zabbix_frontend.get_graph(graph_id, self.from_ts, self.to_ts, self.width, self.height, stream=False, refresh=True)
+            except Exception as e:
+                logging.warning('Warming graph %s failed: %s', graph_id, e)
+                with self.lock:
+                    self.counters['render_failures'] += 1
+                continue
+
+            # When the frontend failed, get_graph returns the old cached graph
+            # instead of raising; then the cache entry hasn't changed.
+            after = zabbix_frontend.graph_cache.get(self._cache_key(graph_id))
+            if after is None or (before is not None and after[0] == before[0]):
+                logging.warning('Warming graph %s failed: frontend unavailable, got the cached graph', graph_id)
+                with self.lock:
+                    self.counters['render_failures'] += 1
+                continue
+
+            with self.lock:
+                self.counters['renders'] += 1
+                self.warmed_at[graph_id] = after[0]
+
+
+    def run(self):
+        while True:
+            cycle_start = time.time()
+
+            try:
+                self.warm()
+            except Exception as e:
+                logging.error('Graph warming failed: %s', e)
+
+            time.sleep(max(0, self.interval - (time.time() - cycle_start)))
+
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+
+        stats['warm_hit_ratio'] = stats['warm_hits'] / stats['views'] if stats['views'] > 0 else 0
+        return stats